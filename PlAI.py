@@ -1,11 +1,15 @@
 import os
 import gi
-import sqlite3
+import threading
+from feature_store import is_feature_store, TimelineReader
+from player_library import open_library, library_is_current, rebuild_library, get_meta, sort_clause
+from library_model import LibraryModel, ModelFiles
+from library_query import QueryRunner
+from playback_queue import PlaybackQueue
+from timeline_strip import TimelineStrip
 
 gi.require_version('Gtk', '3.0')
-gi.require_version('Gst', '1.0')
 from gi.repository import Gtk, GLib, Pango
-import gi.repository.Gst as Gst
 
 class AudioPlayer(Gtk.Window):
 
@@ -35,19 +39,44 @@ class AudioPlayer(Gtk.Window):
         self.load_playlist_button.connect("clicked", self.on_load_playlist_clicked)
         self.main_box.pack_start(self.load_playlist_button, False, False, 0)
 
+        # Progress bar and cancel button shown while the library loads in the background
+        self.load_progress_box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=6)
+        self.load_progress = Gtk.ProgressBar(show_text=True)
+        self.load_progress_box.pack_start(self.load_progress, True, True, 0)
+        self.cancel_load_button = Gtk.Button(label="Cancel")
+        self.cancel_load_button.connect("clicked", self.on_cancel_load_clicked)
+        self.load_progress_box.pack_start(self.cancel_load_button, False, False, 0)
+        self.load_progress_box.set_no_show_all(True)
+        self.main_box.pack_start(self.load_progress_box, False, False, 0)
+        self.load_thread = None
+        self.load_cancel = None
+
+        # Search bar, e.g. tempo:120..128 energy:>0.3 name:"remix"; see library_query.py for the syntax.
+        # SearchEntry debounces typing, and queries run on the search thread, off the main loop.
+        self.search_entry = Gtk.SearchEntry()
+        self.search_entry.set_placeholder_text('Search: artist, title or filename, or tempo:120..128 energy:>0.3 name:"remix"')
+        self.search_entry.connect("search-changed", self.on_search_changed)
+        self.main_box.pack_start(self.search_entry, False, False, 0)
+        self.search = QueryRunner(open_library, lambda *results: GLib.idle_add(self.on_search_results, *results))
+
         # ScrolledWindow for the TreeView
         self.scrolled_window = Gtk.ScrolledWindow()
         self.scrolled_window.set_policy(Gtk.PolicyType.AUTOMATIC, Gtk.PolicyType.AUTOMATIC)
         self.main_box.pack_start(self.scrolled_window, True, True, 0)
 
-        # TreeView and ListStore for playlist
-        self.liststore = Gtk.ListStore(str, str, float, float, float, float, float, str)
-        self.treeview = Gtk.TreeView(model=self.liststore)
+        # TreeView for playlist; rows are fetched lazily from the library by LibraryModel
+        self.treeview = Gtk.TreeView()
+        self.treeview.set_fixed_height_mode(True)
         self.scrolled_window.add(self.treeview)
 
         # Initialize columns
         self.setup_columns()
 
+        # Waveform strip of the playing track, from the timelines stored by analyze_audio_max.py --timeline
+        self.timeline_strip = TimelineStrip(self.on_timeline_seek)
+        self.main_box.pack_start(self.timeline_strip, False, False, 0)
+        self.timelines = None
+
         # Button to play selected audio
         self.play_button = Gtk.Button(label="Play")
         self.play_button.connect("clicked", self.on_play_clicked)
@@ -58,14 +87,23 @@ class AudioPlayer(Gtk.Window):
         self.stop_button.connect("clicked", self.on_stop_clicked)
         self.main_box.pack_start(self.stop_button, False, False, 0)
 
+        # Button to skip to the next track in the playback queue
+        self.next_button = Gtk.Button(label="Next")
+        self.next_button.connect("clicked", self.on_next_clicked)
+        self.main_box.pack_start(self.next_button, False, False, 0)
+
         self.audio_directory = None
         self.database_file = None
 
-        # Initialize GStreamer
-        Gst.init(None)
+        # Playback queue: the tracks after the one being played, in the current view order
+        self.queue = PlaybackQueue(self.on_track_changed)
+        self.playing_view = None
+        self.playing_model = None
+        GLib.timeout_add(250, self.update_timeline_position)
 
-        # GStreamer elements
-        self.player = Gst.ElementFactory.make("playbin", "player")
+        # Open the persistent library and show the tracks from the previous session
+        self.open_library()
+        self.update_playlist_view()
 
     def setup_columns(self):
         # Column titles, data types, and max widths
@@ -83,11 +121,14 @@ class AudioPlayer(Gtk.Window):
             renderer = Gtk.CellRendererText()
             renderer.set_property("ellipsize", Pango.EllipsizeMode.END)
             column = Gtk.TreeViewColumn(title, renderer, text=i+1)  # i+1 because full path is at index 0
-            column.set_sort_column_id(i+1)
+            # Fixed sizing lets the view skip measuring every row of a large library
+            column.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+            column.set_fixed_width(max_width)
+            column.set_clickable(True)
             column.set_resizable(True)
             column.set_min_width(50)
             column.set_max_width(max_width)
-            column.connect("clicked", self.on_column_clicked)
+            column.connect("clicked", self.on_column_clicked, i+1)
             self.treeview.append_column(column)
 
     def on_open_directory_clicked(self, widget):
@@ -115,74 +156,108 @@ class AudioPlayer(Gtk.Window):
         dialog.destroy()
 
     def on_load_playlist_clicked(self, widget):
-        if not self.audio_directory or not self.database_file:
+        if not self.database_file:
+            print("Please select a database file first.")
+            return
+        if not self.audio_directory and not is_feature_store(self.database_file):
             print("Please select both audio directory and database file first.")
             return
 
-        self.create_database()
-        self.load_playlist_to_database()
-        self.update_playlist_view()
+        if self.load_thread is not None:
+            print("The library is already loading.")
+            return
+
+        if library_is_current(self.conn, self.database_file, self.audio_directory):
+            self.update_playlist_view()
+        else:
+            self.load_playlist_to_database()
 
-    def create_database(self):
-        self.conn = sqlite3.connect(':memory:')  # Use in-memory database for speed
-        self.cursor = self.conn.cursor()
-        self.cursor.execute('''CREATE TABLE IF NOT EXISTS playlist
-                            (file TEXT, filename TEXT, tempo REAL, duration REAL, energy REAL,
-                            zero_crossing_rate REAL, danceability REAL, spectral_contrast TEXT)''')
+    def open_library(self):
+        # Persistent library: reopen the previous session's tracks without re-parsing anything
+        self.conn = open_library()
+        self.database_file = get_meta(self.conn, 'database_file')
+        self.audio_directory = get_meta(self.conn, 'audio_directory') or None
 
     def load_playlist_to_database(self):
-        with open(self.database_file, 'r') as file:
-            batch = []
-            for line in file:
-                if line.startswith("File:"):
-                    if batch:
-                        self.insert_entry(batch)
-                        batch = []
-                batch.append(line.strip())
-            if batch:
-                self.insert_entry(batch)
-        
-        self.conn.commit()
-
-    def insert_entry(self, batch):
-        entry = {}
-        for line in batch:
-            if line.startswith("File:"):
-                full_path = os.path.join(self.audio_directory, line[6:].strip())
-                entry['File'] = full_path
-                entry['Filename'] = os.path.basename(full_path)
-            elif line.startswith("Tempo (Librosa)"):
-                entry['Tempo'] = float(line.split(':')[1].strip().split()[0].lstrip('[').rstrip(']'))
-            elif line.startswith("Duration"):
-                entry['Duration'] = float(line.split(':')[1].strip().split()[0])
-            elif line.startswith("Energy"):
-                entry['Energy'] = float(line.split(':')[1].strip())
-            elif line.startswith("Zero Crossing Rate"):
-                entry['Zero Crossing Rate'] = float(line.split(':')[1].strip())
-            elif line.startswith("Danceability"):
-                danceability_values = line.split(':')[1].strip().split(',')
-                entry['Danceability'] = float(danceability_values[0].strip(' ()'))
-            elif line.startswith("Spectral Contrast"):
-                spectral_contrast_values = line.split(':')[1].strip().split(',')
-                entry['Spectral Contrast'] = str([float(val.strip(' []')) for val in spectral_contrast_values])
-
-        self.cursor.execute('''INSERT INTO playlist VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
-                            (entry.get('File', ''), entry.get('Filename', ''), entry.get('Tempo', 0.0), 
-                             entry.get('Duration', 0.0), entry.get('Energy', 0.0), 
-                             entry.get('Zero Crossing Rate', 0.0), entry.get('Danceability', 0.0), 
-                             entry.get('Spectral Contrast', '[]')))
-
-    def update_playlist_view(self):
-        self.liststore.clear()
-        order_by = ""
-        if self.current_sort_column is not None:
-            order_by = f"ORDER BY {self.current_sort_column + 1} {'DESC' if self.current_sort_order == Gtk.SortType.DESCENDING else 'ASC'}"
-        self.cursor.execute(f'''SELECT * FROM playlist {order_by}''')
-        for row in self.cursor.fetchall():
-            self.liststore.append(row)
-
-    def on_column_clicked(self, column):
-        sort_column_id = column.get_sort_column_id()
+        # Parse and import on a worker thread so the window stays responsive;
+        # progress comes back to the main loop through GLib.idle_add
+        self.load_cancel = threading.Event()
+        self.load_progress.set_fraction(0.0)
+        self.load_progress.set_text("Loading library...")
+        self.load_progress_box.show()
+        self.load_progress.show()
+        self.cancel_load_button.show()
+        self.load_thread = threading.Thread(target=self.load_library_worker, daemon=True,
+                                            args=(self.database_file, self.audio_directory, self.load_cancel))
+        self.load_thread.start()
+
+    def load_library_worker(self, database_file, audio_directory, cancel_event):
+        # SQLite connections cannot be shared across threads, so the worker opens its own
+        conn = open_library()
+        try:
+            completed = rebuild_library(conn, database_file, audio_directory,
+                                        lambda loaded, total: GLib.idle_add(self.on_load_progress, loaded, total),
+                                        cancel_event)
+        except Exception as e:
+            print(f"Error loading {database_file}: {e}")
+            completed = False
+        finally:
+            conn.close()
+        GLib.idle_add(self.on_load_finished, completed)
+
+    def on_load_progress(self, loaded, total):
+        self.load_progress.set_fraction(min(1.0, loaded / total) if total else 0.0)
+        self.load_progress.set_text(f"Loaded {loaded} of {total} tracks")
+        return False
+
+    def on_load_finished(self, completed):
+        self.load_thread = None
+        # The library may now come from another feature store
+        if self.timelines is not None:
+            self.timelines.close()
+            self.timelines = None
+        self.load_progress_box.hide()
+        self.update_playlist_view(reload=True)
+        if not completed:
+            print("Library loading was cancelled or failed; the previous library is kept.")
+        return False
+
+    def on_cancel_load_clicked(self, widget):
+        if self.load_cancel is not None:
+            self.load_cancel.set()
+
+    def update_playlist_view(self, reload=False):
+        # The search thread works out the rowids for a query and sort order, and the view gets a fresh
+        # model when they arrive; reload=True after the library itself has changed. Without a query
+        # the model reads the ordered rowids straight from SQLite, as no snapshot is needed for that.
+        text = self.search_entry.get_text()
+        descending = self.current_sort_order == Gtk.SortType.DESCENDING
+        if text.strip():
+            self.search.submit(text, self.current_sort_column, descending, reload)
+            return
+        self.search.cancel(reload)
+        self.search_entry.get_style_context().remove_class("error")
+        self.search_entry.set_tooltip_text(None)
+        self.treeview.set_model(LibraryModel(self.conn, sort_clause(self.current_sort_column, descending)))
+
+    def on_search_changed(self, entry):
+        self.update_playlist_view()
+
+    def on_search_results(self, generation, rowids, message):
+        # Results of a query that has been superseded since are dropped; a query that does not parse
+        # leaves the list as it was and shows why
+        if generation != self.search.generation:
+            return False
+        style = self.search_entry.get_style_context()
+        self.search_entry.set_tooltip_text(message)
+        if rowids is None:
+            style.add_class("error")
+            return False
+        style.remove_class("error")
+        self.treeview.set_model(LibraryModel(self.conn, rowids=rowids))
+        return False
+
+    def on_column_clicked(self, column, sort_column_id):
         if self.current_sort_column == sort_column_id:
             self.current_sort_order = Gtk.SortType.DESCENDING if self.current_sort_order == Gtk.SortType.ASCENDING else Gtk.SortType.ASCENDING
         else:
@@ -195,18 +270,52 @@ class AudioPlayer(Gtk.Window):
 
         self.update_playlist_view()
 
+    def play_from(self, treeview, tracks):
+        # Start the queue at the selected row; the rest of the list plays on gaplessly
+        model, treeiter = treeview.get_selection().get_selected()
+        if treeiter:
+            self.playing_view = treeview
+            self.playing_model = model
+            self.queue.play(tracks, model.get_path(treeiter).get_indices()[0])
+
+    def on_track_changed(self, tracks, index):
+        self.timeline_strip.set_timeline(self.timeline_for(tracks[index]))
+        # Keep the row of the track that is playing in view, unless the list was re-sorted or reloaded since
+        model = self.playing_view.get_model() if self.playing_view is not None else None
+        if model is not None and model is self.playing_model and index < model.iter_n_children(None):
+            self.playing_view.scroll_to_cell(Gtk.TreePath((index,)), None, False, 0, 0)
+
     def on_play_clicked(self, widget):
         # Play selected audio file
-        selection = self.treeview.get_selection()
-        model, treeiter = selection.get_selected()
-        if treeiter:
-            filepath = model[treeiter][0]  # Get full file path from selected row
-            self.player.set_property("uri", "file://" + filepath)
-            self.player.set_state(Gst.State.PLAYING)
+        self.play_from(self.treeview, ModelFiles(self.treeview.get_model()))
 
     def on_stop_clicked(self, widget):
         # Stop audio playback
-        self.player.set_state(Gst.State.NULL)
+        self.queue.stop()
+        self.timeline_strip.set_timeline(None)
+
+    def timeline_for(self, filepath):
+        # Timelines live next to the feature store; a legacy text database has none
+        if self.timelines is None:
+            if not (self.database_file and os.path.exists(self.database_file)
+                    and is_feature_store(self.database_file)):
+                return None
+            self.timelines = TimelineReader(self.database_file)
+        return self.timelines.get(filepath)
+
+    def update_timeline_position(self):
+        if self.queue.index is not None:
+            position = self.queue.position()
+            if position is not None:
+                self.timeline_strip.set_position(position)
+        return True
+
+    def on_timeline_seek(self, seconds):
+        if self.queue.index is not None:
+            self.queue.seek(seconds)
+
+    def on_next_clicked(self, widget):
+        self.queue.next()
 
 win = AudioPlayer()
 win.connect("destroy", Gtk.main_quit)
@@ -1,108 +1,510 @@
 import os
 import argparse
-import numpy as np
-import librosa
-import essentia
-from essentia.standard import MonoLoader, RhythmExtractor2013, Danceability, Energy, Duration, ZeroCrossingRate
-from concurrent.futures import ProcessPoolExecutor
-import threading
+import hashlib
+import fnmatch
+import time
+import json
+import csv
+import sqlite3
+from audio_features import (DUPLICATE_FEATURES, FEATURES, PROFILES, TARGET_SR, DECODERS, RESAMPLE_TYPES,
+                            DEFAULT_RES_TYPE, EXCERPT_POSITIONS, EXCERPT_SECONDS, ffmpeg_available, load_audio,
+                            timed, warm_up, extract_features, extract_features_streaming, needs_streaming, audio_duration,
+                            excerpt_offsets, extract_features_excerpts, fingerprint, read_tags, min_streaming_memory_mb)
+from feature_store import (open_store, open_store_readonly, track_values, write_tracks, delete_tracks, clear_tracks,
+                           get_signature, get_job, iter_stored_paths, queue_jobs, set_job_state, job_attempts,
+                           recover_interrupted_jobs, timeline_file, write_timelines, find_duplicate,
+                           stored_result, iter_duplicates, set_content_hashes)
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 import traceback
 
-file_lock = threading.Lock()
+WRITE_BATCH_SIZE = 100
+FLUSH_INTERVAL = 30
 
-def analyze_and_write_audio_file(audio_file, output_file):
+# Read-only connections to the feature store, opened once per worker process for duplicate lookups
+STORES = {}
+
+def store_connection(store_file):
+    conn = STORES.get(store_file)
+    if conn is None:
+        conn = STORES[store_file] = open_store_readonly(store_file)
+        conn.row_factory = sqlite3.Row
+    return conn
+
+def covering_profiles(features):
+    # Profiles whose tracks have every one of these features
+    return [name for name, profile_features in PROFILES.items() if set(features) <= set(profile_features)]
+
+def analyze_audio_file(audio_file, skip=(), max_memory_mb=None, features=FEATURES, timings=None,
+                       sr=TARGET_SR, res_type=DEFAULT_RES_TYPE, decoder='librosa', excerpt=None, timeline=False,
+                       dedup_store=None):
+    # timings collects the seconds spent in each stage (decode, resample, each extractor).
+    # excerpt is (positions, seconds) to analyze only those windows of long tracks.
+    # timeline adds result['timeline'] for whole-file analysis; excerpts and streamed files have none.
+    # dedup_store is the feature store to look for an already analyzed copy in: the file is fingerprinted
+    # first, and a match's features are reused with duplicate_of set instead of analyzing the file.
+    timings = {} if timings is None else timings
     try:
         print(f"Analyzing file: {audio_file}")
-        y, sr = librosa.load(audio_file)
+        duration = None
+        if excerpt or dedup_store:
+            with timed(timings, 'duration_metadata'):
+                duration = audio_duration(audio_file)
+        track_fingerprint = None
+        if dedup_store:
+            with timed(timings, 'fingerprint'):
+                track_fingerprint = fingerprint(audio_file, duration)
+            original = None
+            if track_fingerprint:
+                with timed(timings, 'duplicate_lookup'):
+                    original = find_duplicate(store_connection(dedup_store), track_fingerprint, duration, audio_file,
+                                              covering_profiles(features))
+            if original is not None:
+                print(f"{audio_file} duplicates {original['path']}, reusing its features")
+                result = stored_result(original)
+                result['duration_librosa'] = duration
+                if 'duration_essentia' in result:
+                    result['duration_essentia'] = duration
+                result['fingerprint'] = track_fingerprint
+                result['duplicate_of'] = original['path']
+                # Tags belong to the file, not the audio, so a copy keeps its own
+                with timed(timings, 'tags'):
+                    result['tags'] = read_tags(audio_file)
+                return result, None
+        offsets = None
+        if excerpt:
+            offsets = excerpt_offsets(duration, *excerpt)
+        # Excerpts are short, so they never need streaming
+        streaming = needs_streaming(audio_file, max_memory_mb, sr) if max_memory_mb and not offsets else False
+        if streaming is None:
+            print(f"Cannot stream {audio_file}: soundfile does not read this format, "
+                  f"so it is decoded whole and may exceed {max_memory_mb} MB")
+        if offsets:
+            result = extract_features_excerpts(audio_file, offsets, excerpt[1], duration, skip, features, timings,
+                                               sr, res_type, decoder)
+        elif streaming:
+            # Streaming always decodes with soundfile, whatever the decoder
+            print(f"Streaming {audio_file} in blocks to stay under "
+                  f"{max(max_memory_mb, min_streaming_memory_mb(sr)):.0f} MB")
+            result = extract_features_streaming(audio_file, max_memory_mb, sr, features, timings, res_type)
+        else:
+            y, sr = load_audio(audio_file, timings, sr, res_type, decoder)
+            result = extract_features(y, sr, skip, features, timings, timeline)
+        if track_fingerprint:
+            result['fingerprint'] = track_fingerprint
+        with timed(timings, 'tags'):
+            result['tags'] = read_tags(audio_file)
 
-        tempo_librosa, _ = librosa.beat.beat_track(y=y, sr=sr)
-        duration_librosa = librosa.get_duration(y=y, sr=sr)
-        zero_crossings_librosa = librosa.feature.zero_crossing_rate(y).mean()
-        spectral_contrast_librosa = librosa.feature.spectral_contrast(y=y, sr=sr).mean(axis=1)
+        print(f"Analysis completed for: {audio_file}")
+        return result, None
+    except Exception as e:
+        print(f'Error analyzing {audio_file}: {str(e)}')
+        traceback.print_exc()
+        return None, f'{type(e).__name__}: {e}'
 
-        audio_essentia = essentia.array(y)
+class TimingReport:
+    # Per-file stage timings collected in the parent, aggregated per stage for the whole run
 
-        danceability_extractor = Danceability()
-        danceability = danceability_extractor(audio_essentia)
+    def __init__(self):
+        self.files = []
+        self.started = time.monotonic()
 
-        energy_extractor = Energy()
-        energy = energy_extractor(audio_essentia)
+    def add(self, path, timings):
+        self.files.append((path, timings))
 
-        rhythm_extractor = RhythmExtractor2013()
-        tempo_essentia, _, _, _, _ = rhythm_extractor(audio_essentia)
+    def stages(self):
+        stages = {}
+        for _, timings in self.files:
+            for stage, seconds in timings.items():
+                total, count = stages.get(stage, (0.0, 0))
+                stages[stage] = (total + seconds, count + 1)
+        return {stage: {'total': total, 'mean': total / count, 'files': count}
+                for stage, (total, count) in sorted(stages.items(), key=lambda item: -item[1][0])}
 
-        duration_extractor = Duration()
-        duration_essentia = duration_extractor(audio_essentia)
+    def write(self, report_file, profile):
+        stages = self.stages()
+        wall_time = time.monotonic() - self.started
+        if report_file.lower().endswith('.csv'):
+            # One row per file and stage, followed by the per-stage totals under the path '*'
+            with open(report_file, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['path', 'stage', 'seconds', 'mean', 'files'])
+                for path, timings in self.files:
+                    for stage, seconds in timings.items():
+                        writer.writerow([path, stage, f'{seconds:.6f}', '', ''])
+                for stage, summary in stages.items():
+                    writer.writerow(['*', stage, f"{summary['total']:.6f}", f"{summary['mean']:.6f}", summary['files']])
+                writer.writerow(['*', 'wall_time', f'{wall_time:.6f}', '', len({path for path, _ in self.files})])
+        else:
+            with open(report_file, 'w') as f:
+                # A retried file has an entry per attempt but counts once
+                json.dump({'profile': profile, 'wall_time': wall_time,
+                           'files_analyzed': len({path for path, _ in self.files}),
+                           'stages': stages,
+                           'files': [{'path': path, 'timings': timings} for path, timings in self.files]},
+                          f, indent=2)
 
-        zero_crossing_rate_extractor = ZeroCrossingRate()
-        zero_crossing_rate = zero_crossing_rate_extractor(audio_essentia)
+class ResultWriter:
+    # Single writer in the parent process. Worker results are buffered and committed in batches,
+    # one transaction per batch, so an interrupted scan never leaves a partial record behind.
 
-        print(f"Analysis completed for: {audio_file}")
-        
-        result = {
-            'filename': os.path.basename(audio_file),
-            'tempo_librosa': tempo_librosa,
-            'duration_librosa': duration_librosa,
-            'zero_crossings_librosa': zero_crossings_librosa,
-            'spectral_contrast_librosa': spectral_contrast_librosa.tolist(),
-            'danceability': danceability,
-            'energy': energy,
-            'tempo_essentia': tempo_essentia,
-            'duration_essentia': duration_essentia,
-            'zero_crossing_rate': zero_crossing_rate,
-        }
-        
-        write_result_to_file(output_file, result)
-        return True
-    except Exception as e:
-        print(f'Error analyzing {audio_file}: {str(e)}')
-        traceback.print_exc()
+    def __init__(self, conn, batch_size=WRITE_BATCH_SIZE, flush_interval=FLUSH_INTERVAL, timeline_path=None,
+                 profile='full'):
+        self.conn = conn
+        self.profile = profile
+        self.timeline_path = timeline_path
+        self.timelines = []
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.batch = []
+        self.written = 0
+        self.duplicates = 0
+        self.last_flush = time.monotonic()
+
+    def add(self, path, signature, result):
+        # A duplicate keeps the profile of the track its features came from
+        result.setdefault('profile', self.profile)
+        self.batch.append(track_values(path, signature, result))
+        if result.get('duplicate_of'):
+            self.duplicates += 1
+        if self.timeline_path and 'timeline' in result:
+            self.timelines.append((path, result['timeline']))
+        if len(self.batch) >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self.timelines:
+            write_timelines(self.conn, self.timeline_path, self.timelines)
+            self.timelines = []
+        if self.batch:
+            write_tracks(self.conn, self.batch)
+            self.written += len(self.batch)
+            print(f"Wrote {len(self.batch)} results ({self.written} total)")
+            self.batch = []
+        self.last_flush = time.monotonic()
+
+AUDIO_EXTENSIONS = ('.mp3', '.wav', '.flac')
+
+def walk_audio_files(directory, extensions=AUDIO_EXTENSIONS, include=(), exclude=()):
+    # Depth-first os.scandir walk that yields (path, stat) as files are found, so analysis can start
+    # before the whole tree is listed. include/exclude are globs matched against the path relative
+    # to directory; an excluded directory is not descended into.
+    stack = [directory]
+    while stack:
+        current = stack.pop()
+        try:
+            entries = sorted(os.scandir(current), key=lambda entry: entry.name)
+        except OSError as e:
+            print(f'Cannot read {current}: {e}')
+            continue
+        subdirectories = []
+        for entry in entries:
+            relative = os.path.relpath(entry.path, directory)
+            if any(fnmatch.fnmatch(relative, pattern) for pattern in exclude):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.path)
+            elif entry.is_file() and entry.name.lower().endswith(extensions):
+                if include and not any(fnmatch.fnmatch(relative, pattern) for pattern in include):
+                    continue
+                yield entry.path, entry.stat()
+        stack.extend(reversed(subdirectories))
+
+def file_signature(audio_file, use_hash=False, stat=None):
+    stat = stat or os.stat(audio_file)
+    signature = {'size': stat.st_size, 'mtime': stat.st_mtime}
+    if use_hash:
+        digest = hashlib.sha1()
+        with open(audio_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        signature['hash'] = digest.hexdigest()
+    return signature
+
+def is_unchanged(entry, signature):
+    if entry is None:
+        return False
+    if entry.get('size') != signature['size'] or entry.get('mtime') != signature['mtime']:
         return False
+    # A track stored without a hash is judged on size and mtime; its hash is recorded now
+    if 'hash' in signature and entry.get('hash') is not None and entry['hash'] != signature['hash']:
+        return False
+    return True
+
+def init_worker(sr):
+    # Pool initializer: pay the librosa/Essentia import, extractor construction and numba compilation
+    # once per worker instead of on the worker's first file
+    warm_up(sr)
+
+def process_files(args):
+    # A chunk of files per task, so short clips do not pay one round trip each
+    files, skip, max_memory_mb, features, decoding = args
+    results = []
+    for file in files:
+        timings = {}
+        result, error = analyze_audio_file(file, skip, max_memory_mb, features, timings, **decoding)
+        results.append((result, error, timings))
+    return results
+
+def make_executor(workers, sr, max_tasks_per_child=None):
+    # max_tasks_per_child recycles workers to contain leaks in native extractors; the standard library
+    # then uses the spawn start method, which the initializer's warm-up makes up for
+    options = {'max_tasks_per_child': max_tasks_per_child} if max_tasks_per_child else {}
+    return ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(sr,), **options)
+
+def run_jobs(conn, files, skip, max_memory_mb, max_attempts, workers, features=FEATURES, report=None,
+             decoding=None, chunk_size=1, max_tasks_per_child=None, timeline_path=None, profile='full'):
+    # decoding holds the sr, res_type, decoder, excerpt, timeline and dedup_store keyword arguments of
+    # analyze_audio_file. Duplicates are found among results already committed, so a copy met within
+    # the same batch as its original is analyzed again.
+    # Keeps a bounded number of chunks in flight and journals each file: 'running' when submitted,
+    # 'done' when its result is committed, retried on failure until max_attempts, then 'failed'.
+    # A file that takes down its worker process breaks the pool, which cannot tell which file it was.
+    # The pool is recreated and every file that was in flight becomes a suspect: suspects run one at a
+    # time, and only a file that crashes while running alone counts a crashed attempt. Repeat offenders
+    # end up 'quarantined'; the rest of the suspects simply finish.
+    # files is consumed lazily, so a directory walk feeding it only runs ahead of the workers by the window size.
+    writer = ResultWriter(conn, timeline_path=timeline_path, profile=profile)
+    decoding = decoding or {}
+    sr = decoding.get('sr', TARGET_SR)
+    files = iter(files)
+    retries = deque()
+    suspects = deque()
+    in_flight = {}
+    failed = []
+
+    def record_failure(item, error, crashed):
+        path = item[0]
+        if job_attempts(conn, path) + 1 < max_attempts:
+            set_job_state(conn, [path], 'pending', error, attempt=True)
+            # A crash is retried alone too, so it cannot cast suspicion on other files again
+            (suspects if crashed else retries).append(item)
+        else:
+            set_job_state(conn, [path], 'quarantined' if crashed else 'failed', error, attempt=True)
+            failed.append(path)
+            print(f'Giving up on {path}: {error}')
 
-def write_result_to_file(output_file, result):
-    with file_lock:
-        with open(output_file, 'a') as f:
-            f.write(f"File: {result['filename']}\n")
-            f.write(f"  Tempo (Librosa): {result['tempo_librosa']} BPM\n")
-            f.write(f"  Duration (Librosa): {result['duration_librosa']} seconds\n")
-            f.write(f"  Zero Crossing Rate (Librosa): {result['zero_crossings_librosa']}\n")
-            f.write(f"  Spectral Contrast (Librosa): {result['spectral_contrast_librosa']}\n")
-            f.write(f"  Danceability (Essentia): {result['danceability']}\n")
-            f.write(f"  Energy (Essentia): {result['energy']}\n")
-            f.write(f"  Tempo (Essentia): {result['tempo_essentia']} BPM\n")
-            f.write(f"  Duration (Essentia): {result['duration_essentia']} seconds\n")
-            f.write(f"  Zero Crossing Rate (Essentia): {result['zero_crossing_rate']}\n")
-            f.write('\n')
-        print(f"Wrote results for {result['filename']} to {output_file}")
-
-def process_file(args):
-    file, output_file = args
-    return analyze_and_write_audio_file(file, output_file)
+    def next_chunk(discovered):
+        chunk = []
+        while len(chunk) < chunk_size:
+            if retries:
+                chunk.append(retries.popleft())
+            else:
+                item = next(files, None)
+                if item is None:
+                    break
+                discovered.append(item)
+                chunk.append(item)
+        return chunk
+
+    executor = make_executor(workers, sr, max_tasks_per_child)
+    try:
+        while True:
+            discovered = []
+            submitted = []
+            while len(in_flight) < workers * 2:
+                isolating = bool(suspects)
+                if isolating:
+                    if in_flight:
+                        break
+                    chunk = [suspects.popleft()]
+                else:
+                    chunk = next_chunk(discovered)
+                if not chunk:
+                    break
+                paths = [item[0] for item in chunk]
+                try:
+                    future = executor.submit(process_files, (paths, skip, max_memory_mb, features, decoding))
+                except BrokenProcessPool:
+                    # A worker died since the last wait. This chunk never ran, so it goes back unblamed, and
+                    # the crash itself is dealt with when the futures in flight come back
+                    (suspects if isolating else retries).extendleft(reversed(chunk))
+                    if in_flight:
+                        break
+                    executor = make_executor(workers, sr, max_tasks_per_child)
+                    continue
+                in_flight[future] = chunk
+                submitted.extend(paths)
+            queue_jobs(conn, discovered)
+            set_job_state(conn, submitted, 'running')
+            if not in_flight:
+                break
+
+            alone = sum(len(chunk) for chunk in in_flight.values()) == 1
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            crashed = []
+            for future in done:
+                chunk = in_flight.pop(future)
+                try:
+                    results = future.result()
+                except BrokenProcessPool:
+                    crashed.extend(chunk)
+                    continue
+                for item, (result, error, timings) in zip(chunk, results):
+                    if report is not None:
+                        report.add(item[0], timings)
+                    if result is not None:
+                        writer.add(item[0], item[1], result)
+                    else:
+                        record_failure(item, error, crashed=False)
+
+            if crashed:
+                writer.flush()
+                for chunk in in_flight.values():
+                    crashed.extend(chunk)
+                in_flight = {}
+                executor.shutdown(wait=False, cancel_futures=True)
+                executor = make_executor(workers, sr, max_tasks_per_child)
+                if alone:
+                    record_failure(crashed[0], 'worker process crashed', crashed=True)
+                else:
+                    set_job_state(conn, [item[0] for item in crashed], 'pending')
+                    suspects.extend(crashed)
+    finally:
+        writer.flush()
+        executor.shutdown(wait=True, cancel_futures=True)
+    return writer.written, len(failed), writer.duplicates
 
 def main():
-    parser = argparse.ArgumentParser(description='Analyze audio files in a directory and output results to a text file.')
-    parser.add_argument('directory', type=str, help='Directory containing audio files to analyze.')
+    parser = argparse.ArgumentParser(description='Analyze audio files in a directory tree and store the results in a feature store.')
+    parser.add_argument('directory', type=str, help='Directory tree containing audio files to analyze.')
+    parser.add_argument('--output', type=str, default='scanned_db.sqlite', help='Feature store to write.')
+    parser.add_argument('--full', action='store_true', help='Re-analyze every file, ignoring stored signatures.')
+    parser.add_argument('--hash', action='store_true', help='Also compare file content hashes to detect changes.')
+    parser.add_argument('--skip', action='append', default=[], choices=DUPLICATE_FEATURES,
+                        help='Skip a duplicate Essentia extractor and reuse the shared librosa value (repeatable).')
+    parser.add_argument('--skip-duplicates', action='store_true', help='Skip all duplicate Essentia extractors.')
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='full',
+                        help='Features to compute: "fast" is duration, energy and zero crossing rate only '
+                             '(and implies --skip-duplicates), "full" is everything.')
+    parser.add_argument('--sample-rate', type=int, default=TARGET_SR,
+                        help='Analysis sample rate; 11025 roughly halves decode and feature cost (see README).')
+    parser.add_argument('--resample', choices=RESAMPLE_TYPES, default=DEFAULT_RES_TYPE,
+                        help='Resampler quality; soxr_lq and soxr_qq are much faster than the default soxr_hq.')
+    parser.add_argument('--decoder', choices=DECODERS, default='librosa',
+                        help='"ffmpeg" decodes and resamples in one ffmpeg process at the target rate.')
+    parser.add_argument('--excerpt', action='store_true',
+                        help='Analyze only short windows of long tracks; duration still comes from the file.')
+    parser.add_argument('--excerpt-positions', type=str, default=','.join(str(p) for p in EXCERPT_POSITIONS),
+                        help='Comma-separated window centres as fractions of the duration.')
+    parser.add_argument('--excerpt-seconds', type=float, default=EXCERPT_SECONDS, help='Length of each window.')
+    parser.add_argument('--timeline', action='store_true',
+                        help='Also keep a compact RMS/energy/beat timeline per track for the player (<output>.timeline).')
+    parser.add_argument('--no-dedup', action='store_true',
+                        help='Analyze every file, even when a stored track has the same audio fingerprint.')
+    parser.add_argument('--duplicate-report', type=str, default=None,
+                        help='Write a CSV of original,duplicate paths for the whole store to this file.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of worker processes.')
+    parser.add_argument('--chunk-size', type=int, default=1,
+                        help='Files per worker task; 8-32 cuts per-file overhead on libraries of short clips.')
+    parser.add_argument('--max-tasks-per-child', type=int, default=None,
+                        help='Replace each worker after this many tasks to contain memory leaks.')
+    parser.add_argument('--timing-report', type=str, default=None,
+                        help='Write per-file and per-stage analysis timings to this file (.json or .csv).')
+    parser.add_argument('--max-memory-mb', type=int, default=None,
+                        help='Per-worker memory cap; longer files are analyzed in streaming blocks to stay under it.')
+    parser.add_argument('--max-attempts', type=int, default=3,
+                        help='Attempts per file before it is marked failed or quarantined.')
+    parser.add_argument('--retry-failed', action='store_true', help='Retry files that failed or were quarantined.')
+    parser.add_argument('--extensions', type=str, default=','.join(ext.lstrip('.') for ext in AUDIO_EXTENSIONS),
+                        help='Comma-separated audio file extensions to analyze.')
+    parser.add_argument('--include', action='append', default=[],
+                        help='Only analyze files whose path relative to the directory matches this glob (repeatable).')
+    parser.add_argument('--exclude', action='append', default=[],
+                        help='Skip files and directories whose relative path matches this glob (repeatable).')
     args = parser.parse_args()
 
-    directory = args.directory
-    output_file = 'scanned_db.txt'
+    directory = os.path.abspath(args.directory)
+    features = PROFILES[args.profile]
+    skip = tuple(DUPLICATE_FEATURES) if args.skip_duplicates or args.profile == 'fast' else tuple(args.skip)
+    report = TimingReport() if args.timing_report else None
+    decoding = {'sr': args.sample_rate, 'res_type': args.resample, 'decoder': args.decoder}
+    if args.timeline:
+        decoding['timeline'] = True
+    if args.excerpt:
+        decoding['excerpt'] = (tuple(float(p) for p in args.excerpt_positions.split(',')), args.excerpt_seconds)
+    output_file = args.output
+    if not args.no_dedup:
+        decoding['dedup_store'] = os.path.abspath(output_file)
+    extensions = tuple('.' + extension.lower().lstrip('.') for extension in args.extensions.split(','))
 
     if not os.path.isdir(directory):
-        print(f'The directory {directory} does not exist.')
+        print(f'The directory {args.directory} does not exist.')
         return
+    if args.decoder == 'ffmpeg' and not ffmpeg_available():
+        print('The ffmpeg decoder was requested but ffmpeg is not on the PATH.')
+        return
+    if args.max_memory_mb and args.max_memory_mb < min_streaming_memory_mb(args.sample_rate):
+        print(f'Warning: --max-memory-mb {args.max_memory_mb} is below the smallest streaming block at '
+              f'{args.sample_rate} Hz; long files will still use about {min_streaming_memory_mb(args.sample_rate):.0f} MB')
+
+    conn = open_store(output_file)
+    if args.full:
+        clear_tracks(conn)
+        # Timelines are only ever appended, so a full re-scan is the time to start the file over
+        if os.path.exists(timeline_file(output_file)):
+            os.remove(timeline_file(output_file))
+    interrupted = recover_interrupted_jobs(conn, args.max_attempts)
+    if interrupted:
+        print(f"Resuming: {interrupted} files were interrupted by the previous run")
+
+    counts = {'found': 0, 'unchanged': 0, 'given_up': 0, 'pending': 0, 'upgraded': 0}
+    profiles = covering_profiles(features)
+    new_hashes = []
 
-    files = [os.path.join(directory, filename) for filename in os.listdir(directory)
-             if filename.endswith(('.mp3', '.wav', '.flac'))]
+    def pending_files():
+        # Only new or changed files are sent to the analyzer; files that already failed or crashed
+        # a worker are left alone until they change or --retry-failed is given
+        for path, stat in walk_audio_files(directory, extensions, args.include, args.exclude):
+            counts['found'] += 1
+            signature = file_signature(path, args.hash, stat)
+            stored = get_signature(conn, path)
+            # An unchanged file analyzed with a profile that left out requested features is analyzed again
+            upgrade = is_unchanged(stored, signature)
+            if upgrade and 'hash' in signature and stored['hash'] is None:
+                new_hashes.append((path, signature['hash']))
+            if upgrade and stored['profile'] in profiles:
+                counts['unchanged'] += 1
+                continue
+            job = get_job(conn, path)
+            if job is not None and job['state'] in ('failed', 'quarantined'):
+                if args.retry_failed:
+                    queue_jobs(conn, [(path, signature)], reset_attempts=True)
+                elif (job['size'], job['mtime']) == (signature['size'], signature['mtime']):
+                    counts['given_up'] += 1
+                    continue
+            counts['pending'] += 1
+            counts['upgraded'] += upgrade
+            yield path, signature
 
-    print(f"Found {len(files)} audio files to process")
+    successful_analyses, failed, duplicates = run_jobs(conn, pending_files(), skip, args.max_memory_mb,
+                                           args.max_attempts, args.workers, features, report, decoding,
+                                           max(1, args.chunk_size), args.max_tasks_per_child,
+                                           timeline_file(output_file) if args.timeline else None, args.profile)
+    set_content_hashes(conn, new_hashes)
+    if report is not None:
+        report.write(args.timing_report, args.profile)
+        print(f'Timing report written to {args.timing_report}')
 
-    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
-        results = list(executor.map(process_file, [(file, output_file) for file in files]))
+    # Files that disappeared from the tree are pruned from the store
+    removed = [path for path in iter_stored_paths(conn, directory) if not os.path.exists(path)]
+    delete_tracks(conn, removed)
 
-    successful_analyses = sum(results)
-    print(f'All processing completed. Analyzed {successful_analyses} out of {len(files)} files.')
-    print(f'Results written to {output_file}')
-    print(f'Total lines in output file: {sum(1 for line in open(output_file))}')
+    print(f"Found {counts['found']} audio files: {counts['unchanged']} unchanged, "
+          f"{counts['pending'] - counts['upgraded']} new or changed, "
+          f"{counts['upgraded']} missing features of the {args.profile} profile, "
+          f"{counts['given_up']} skipped after earlier failures, {len(removed)} removed")
+    print(f'All processing completed. Analyzed {successful_analyses} out of {counts["pending"]} files, {failed} failed, '
+          f'{duplicates} reused the features of a duplicate.')
+    if args.duplicate_report:
+        with open(args.duplicate_report, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['original', 'duplicate'])
+            writer.writerows(iter_duplicates(conn))
+        print(f'Duplicate report written to {args.duplicate_report}')
+    print(f'Results written to {output_file} ({conn.execute("SELECT COUNT(*) FROM tracks").fetchone()[0]} tracks)')
+    conn.close()
 
 if __name__ == '__main__':
     main()
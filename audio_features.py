@@ -0,0 +1,396 @@
+import time
+import shutil
+import subprocess
+from contextlib import contextmanager
+import numpy as np
+import librosa
+import soundfile
+import soxr
+import essentia
+from essentia.standard import RhythmExtractor2013, Danceability, Duration, ZeroCrossingRate
+from feature_store import TAG_COLUMNS, FINGERPRINT_MIN_BIT_FRACTION
+
+try:
+    import mutagen
+except ImportError:
+    mutagen = None
+
+# Essentia extractors that only duplicate a feature already derived from the shared intermediates.
+# When one is skipped, its output field is filled with the shared (librosa) value instead.
+DUPLICATE_FEATURES = ('tempo_essentia', 'duration_essentia', 'zero_crossing_rate')
+
+TARGET_SR = 22050
+FRAME_LENGTH = 2048
+HOP_LENGTH = 512
+# Rough peak working-set per decoded sample in a streamed block (framed ZCR, complex STFT, magnitudes, mel)
+BYTES_PER_SAMPLE = 160
+# Tempogram window matching librosa.feature.tempo's default 8 s autocorrelation size
+TEMPOGRAM_SECONDS = 8.0
+# Lowest spectral contrast band edge at TARGET_SR; it scales down with lower rates to stay under Nyquist
+CONTRAST_FMIN = 200.0
+
+# Decoding options for bulk scans. 'ffmpeg' decodes, downmixes and resamples in one external process
+# straight into a float32 buffer; res_type is then ignored. See README for the accuracy trade-offs.
+DECODERS = ('librosa', 'ffmpeg')
+RESAMPLE_TYPES = ('soxr_vhq', 'soxr_hq', 'soxr_mq', 'soxr_lq', 'soxr_qq', 'polyphase')
+DEFAULT_RES_TYPE = 'soxr_hq'
+
+# Timeline kept per track for the player's waveform strip: this many RMS points over the whole track
+TIMELINE_POINTS = 400
+
+# Audio fingerprint: signs of band-energy differences over a short window at 40% of the track, robust
+# to re-encoding and resampling; feature_store compares them by Hamming distance
+FINGERPRINT_SR = 11025
+FINGERPRINT_SECONDS = 8.0
+FINGERPRINT_POSITION = 0.4
+FINGERPRINT_BANDS = 17
+FINGERPRINT_SLICES = 17
+# A window quieter than this mean band power per frame (noise at about -60 dBFS) says nothing about
+# the track: silent windows all give the same bits
+FINGERPRINT_MIN_BAND_POWER = 1.0
+
+# Excerpt mode: only these windows (centre as a fraction of the duration, length in seconds) are decoded
+EXCERPT_POSITIONS = (0.2, 0.5, 0.8)
+EXCERPT_SECONDS = 30.0
+
+# Feature groups that can be switched off; a profile is the set of groups it computes
+FEATURES = ('tempo', 'duration', 'zero_crossing_rate', 'spectral_contrast', 'energy', 'danceability')
+PROFILES = {
+    'fast': ('duration', 'energy', 'zero_crossing_rate'),
+    'full': FEATURES,
+}
+
+def first_value(value):
+    return float(np.atleast_1d(value)[0])
+
+@contextmanager
+def timed(timings, stage):
+    # Adds the wall time of the block to timings[stage], in seconds
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+# Essentia algorithms built in this process, by algorithm and parameters
+EXTRACTORS = {}
+
+def extractor(algorithm, **parameters):
+    # Building an algorithm is expensive (RhythmExtractor2013 takes ~0.2 s), so each one is built once
+    # per process and reset before it is reused for the next file
+    key = (algorithm, tuple(sorted(parameters.items())))
+    instance = EXTRACTORS.get(key)
+    if instance is None:
+        instance = EXTRACTORS[key] = algorithm(**parameters)
+    else:
+        instance.reset()
+    return instance
+
+def warm_up(sr=TARGET_SR):
+    # Builds every extractor and runs the full pipeline once on a short noise clip, so lazy imports
+    # and numba compilation happen before the first real file
+    noise = np.random.default_rng(0).standard_normal(4 * sr).astype(np.float32) * 0.1
+    extract_features(noise, sr)
+
+def tempogram_frames(sr):
+    return int(round(TEMPOGRAM_SECONDS * sr / HOP_LENGTH))
+
+def contrast_fmin(sr):
+    return CONTRAST_FMIN * min(1.0, sr / TARGET_SR)
+
+def ffmpeg_available():
+    return shutil.which('ffmpeg') is not None
+
+def decode_ffmpeg(audio_file, sr, offset=0.0, duration=None):
+    # -ss before -i seeks in the input instead of decoding up to the offset
+    command = ['ffmpeg', '-nostdin', '-v', 'error', '-ss', str(offset)]
+    if duration is not None:
+        command += ['-t', str(duration)]
+    command += ['-i', audio_file, '-f', 'f32le', '-ac', '1', '-ar', str(sr), '-']
+    process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if process.returncode != 0:
+        raise RuntimeError(f'ffmpeg could not decode {audio_file}: {process.stderr.decode(errors="replace").strip()}')
+    return np.frombuffer(process.stdout, dtype=np.float32)
+
+def load_audio(audio_file, timings, sr=TARGET_SR, res_type=DEFAULT_RES_TYPE, decoder='librosa',
+               offset=0.0, duration=None):
+    # With the defaults this is librosa.load(audio_file), with decoding and resampling timed separately
+    if decoder == 'ffmpeg':
+        with timed(timings, 'decode'):
+            return decode_ffmpeg(audio_file, sr, offset, duration), sr
+    with timed(timings, 'decode'):
+        y, native_sr = librosa.load(audio_file, sr=None, offset=offset, duration=duration)
+    with timed(timings, 'resample'):
+        if native_sr != sr:
+            y = librosa.resample(y, orig_sr=native_sr, target_sr=sr, res_type=res_type)
+    return y, sr
+
+def compute_timeline(y, sr, beat_frames=None):
+    # Downsampled RMS envelope, per-second energy (at TARGET_SR scale, like 'energy') and beat times in seconds
+    cumulative = np.concatenate([[0.0], np.cumsum(np.square(y, dtype=np.float64))])
+    edges = np.linspace(0, len(y), min(TIMELINE_POINTS, max(1, len(y) // HOP_LENGTH)) + 1).astype(int)
+    rms = np.sqrt(np.diff(cumulative[edges]) / np.maximum(np.diff(edges), 1))
+    seconds = np.minimum(np.arange(int(np.ceil(len(y) / sr)) + 1) * sr, len(y))
+    energy = np.diff(cumulative[seconds]) * TARGET_SR / sr
+    beats = (librosa.frames_to_time(beat_frames, sr=sr, hop_length=HOP_LENGTH)
+             if beat_frames is not None else np.zeros(0))
+    return {'duration': len(y) / sr, 'rms': rms.astype(np.float32), 'energy': energy.astype(np.float32),
+            'beats': np.asarray(beats, dtype=np.float32)}
+
+def extract_features(y, sr, skip=(), features=FEATURES, timings=None, timeline=False):
+    # Shared intermediates: one STFT magnitude and one onset envelope feed every spectral and rhythm feature.
+    # Fields of feature groups that are not computed are left out of the result.
+    timings = {} if timings is None else timings
+    result = {}
+    beat_frames = None
+    audio_essentia = essentia.array(y)
+
+    if 'tempo' in features or 'spectral_contrast' in features:
+        with timed(timings, 'stft'):
+            stft_magnitude = np.abs(librosa.stft(y))
+
+    if 'tempo' in features:
+        with timed(timings, 'onset_envelope'):
+            mel_power = librosa.feature.melspectrogram(S=stft_magnitude ** 2, sr=sr)
+            # Median across bands, as beat_track(y=...) aggregates, so tempos match earlier scans
+            onset_envelope = librosa.onset.onset_strength(S=librosa.power_to_db(mel_power), sr=sr,
+                                                          aggregate=np.median)
+        with timed(timings, 'beat_track'):
+            tempo_librosa, beat_frames = librosa.beat.beat_track(onset_envelope=onset_envelope, sr=sr)
+        result['tempo_librosa'] = first_value(tempo_librosa)
+        if 'tempo_essentia' in skip:
+            result['tempo_essentia'] = result['tempo_librosa']
+        else:
+            with timed(timings, 'rhythm_extractor_2013'):
+                result['tempo_essentia'] = float(extractor(RhythmExtractor2013)(audio_essentia)[0])
+
+    if 'duration' in features:
+        result['duration_librosa'] = len(y) / sr
+        if 'duration_essentia' in skip:
+            result['duration_essentia'] = result['duration_librosa']
+        else:
+            with timed(timings, 'duration_essentia'):
+                result['duration_essentia'] = float(extractor(Duration, sampleRate=sr)(audio_essentia))
+
+    if 'zero_crossing_rate' in features:
+        with timed(timings, 'zero_crossing_rate'):
+            result['zero_crossings_librosa'] = float(librosa.feature.zero_crossing_rate(y).mean())
+        if 'zero_crossing_rate' in skip:
+            result['zero_crossing_rate'] = result['zero_crossings_librosa']
+        else:
+            with timed(timings, 'zero_crossing_rate_essentia'):
+                result['zero_crossing_rate'] = float(extractor(ZeroCrossingRate)(audio_essentia))
+
+    if 'spectral_contrast' in features:
+        with timed(timings, 'spectral_contrast'):
+            spectral_contrast = librosa.feature.spectral_contrast(S=stft_magnitude, sr=sr,
+                                                                  fmin=contrast_fmin(sr)).mean(axis=1)
+        result['spectral_contrast_librosa'] = spectral_contrast.tolist()
+
+    if 'energy' in features:
+        with timed(timings, 'energy'):
+            # Sum of squares grows with the sample count, so it is expressed at TARGET_SR for comparability
+            result['energy'] = float(np.dot(y, y)) * TARGET_SR / sr
+
+    if 'danceability' in features:
+        with timed(timings, 'danceability'):
+            danceability, _ = extractor(Danceability, sampleRate=sr)(audio_essentia)
+        result['danceability'] = float(danceability)
+
+    if timeline:
+        with timed(timings, 'timeline'):
+            result['timeline'] = compute_timeline(y, sr, beat_frames)
+
+    return result
+
+def min_streaming_memory_mb(sr=TARGET_SR):
+    # Working set of the smallest streaming block, two tempogram windows long; a lower cap cannot be met
+    return 2 * tempogram_frames(sr) * HOP_LENGTH * BYTES_PER_SAMPLE / 2 ** 20
+
+def needs_streaming(audio_file, max_memory_mb, sr=TARGET_SR):
+    # None when soundfile cannot read the file, which then can only be decoded whole
+    try:
+        info = soundfile.info(audio_file)
+    except RuntimeError:
+        return None
+    decoded_samples = info.frames * info.channels + info.frames * sr / info.samplerate
+    return decoded_samples * BYTES_PER_SAMPLE > max_memory_mb * 2 ** 20
+
+def stream_blocks(audio_file, sr, block_frames, totals, res_type=DEFAULT_RES_TYPE):
+    # Yields mono blocks at the target rate that overlap by FRAME_LENGTH - HOP_LENGTH samples, like librosa.stream,
+    # while only holding one block plus one decoded chunk in memory. Energy and length are accumulated
+    # from the non-overlapping decoded chunks.
+    block_samples = (block_frames - 1) * HOP_LENGTH + FRAME_LENGTH
+    advance = block_frames * HOP_LENGTH
+    with soundfile.SoundFile(audio_file) as f:
+        # The streaming resampler is always soxr; a non-soxr res_type falls back to its default quality
+        quality = res_type[len('soxr_'):].upper() if res_type.startswith('soxr_') else 'HQ'
+        resampler = (soxr.ResampleStream(f.samplerate, sr, 1, dtype='float32', quality=quality)
+                     if f.samplerate != sr else None)
+        buffer = np.zeros(0, dtype=np.float32)
+        chunks = f.blocks(blocksize=advance, dtype='float32', always_2d=True)
+        for chunk in chunks:
+            mono = chunk.mean(axis=1)
+            if resampler is not None:
+                mono = resampler.resample_chunk(mono)
+            totals['energy'] += float(np.dot(mono, mono))
+            totals['samples'] += len(mono)
+            buffer = np.concatenate([buffer, mono])
+            while len(buffer) >= block_samples:
+                yield buffer[:block_samples]
+                buffer = buffer[advance:]
+        if resampler is not None:
+            tail = resampler.resample_chunk(np.zeros(0, dtype=np.float32), last=True)
+            totals['energy'] += float(np.dot(tail, tail))
+            totals['samples'] += len(tail)
+            buffer = np.concatenate([buffer, tail])
+        while len(buffer) >= FRAME_LENGTH:
+            yield buffer[:block_samples]
+            buffer = buffer[advance:]
+
+def extract_features_streaming(audio_file, max_memory_mb, sr=TARGET_SR, features=FEATURES, timings=None,
+                               res_type=DEFAULT_RES_TYPE):
+    # Bounded-memory variant of extract_features: running sums per block instead of whole-signal arrays.
+    # Essentia's whole-signal duplicates are not available here, so their fields reuse the shared values,
+    # and danceability is the length-weighted mean over blocks.
+    timings = {} if timings is None else timings
+    block_frames = max(2 * tempogram_frames(sr), int(max_memory_mb * 2 ** 20 / BYTES_PER_SAMPLE) // HOP_LENGTH)
+    advance = block_frames * HOP_LENGTH
+    totals = {'energy': 0.0, 'samples': 0}
+    tempogram_sum = 0.0
+    zcr_sum = 0.0
+    contrast_sum = 0.0
+    frames = 0
+    danceability_sum = 0.0
+    danceability_weight = 0
+
+    danceability_extractor = extractor(Danceability, sampleRate=sr)
+    blocks = stream_blocks(audio_file, sr, block_frames, totals, res_type)
+    while True:
+        # Decoding and resampling happen inside the block generator
+        with timed(timings, 'decode'):
+            block = next(blocks, None)
+        if block is None:
+            break
+        frames += 1 + (len(block) - FRAME_LENGTH) // HOP_LENGTH
+
+        if 'tempo' in features or 'spectral_contrast' in features:
+            with timed(timings, 'stft'):
+                stft_magnitude = np.abs(librosa.stft(block, n_fft=FRAME_LENGTH, hop_length=HOP_LENGTH, center=False))
+        if 'tempo' in features:
+            with timed(timings, 'onset_envelope'):
+                mel_power = librosa.feature.melspectrogram(S=stft_magnitude ** 2, sr=sr)
+                onset_envelope = librosa.onset.onset_strength(S=librosa.power_to_db(mel_power), sr=sr, center=False,
+                                                              aggregate=np.median)
+            # Summing per-block tempograms gives the same time-averaged tempogram that tempo estimation uses
+            with timed(timings, 'tempogram'):
+                tempogram_sum = tempogram_sum + librosa.feature.tempogram(
+                    onset_envelope=onset_envelope, sr=sr, hop_length=HOP_LENGTH,
+                    win_length=tempogram_frames(sr)).sum(axis=1)
+        if 'zero_crossing_rate' in features:
+            with timed(timings, 'zero_crossing_rate'):
+                zcr_sum += librosa.feature.zero_crossing_rate(block, frame_length=FRAME_LENGTH,
+                                                              hop_length=HOP_LENGTH, center=False).sum()
+        if 'spectral_contrast' in features:
+            with timed(timings, 'spectral_contrast'):
+                contrast_sum = contrast_sum + librosa.feature.spectral_contrast(
+                    S=stft_magnitude, sr=sr, fmin=contrast_fmin(sr)).sum(axis=1)
+        if 'danceability' in features:
+            with timed(timings, 'danceability'):
+                fresh = block[:advance]
+                danceability, _ = danceability_extractor(essentia.array(fresh))
+                danceability_sum += float(danceability) * len(fresh)
+                danceability_weight += len(fresh)
+
+    if frames == 0:
+        raise ValueError(f'{audio_file} is too short to analyze')
+
+    result = {}
+    if 'tempo' in features:
+        with timed(timings, 'beat_track'):
+            tempo = librosa.feature.tempo(tg=(tempogram_sum / frames)[:, np.newaxis], sr=sr, hop_length=HOP_LENGTH)
+        result['tempo_librosa'] = result['tempo_essentia'] = first_value(tempo)
+    if 'duration' in features:
+        result['duration_librosa'] = result['duration_essentia'] = totals['samples'] / sr
+    if 'zero_crossing_rate' in features:
+        result['zero_crossings_librosa'] = result['zero_crossing_rate'] = float(zcr_sum / frames)
+    if 'spectral_contrast' in features:
+        result['spectral_contrast_librosa'] = (contrast_sum / frames).tolist()
+    if 'energy' in features:
+        result['energy'] = totals['energy'] * TARGET_SR / sr
+    if 'danceability' in features:
+        result['danceability'] = danceability_sum / danceability_weight
+    return result
+
+def audio_duration(audio_file):
+    # Exact duration from the file header where soundfile can read it, otherwise from librosa's fallbacks
+    try:
+        info = soundfile.info(audio_file)
+        return info.frames / info.samplerate
+    except RuntimeError:
+        return librosa.get_duration(path=audio_file)
+
+def excerpt_offsets(duration, positions=EXCERPT_POSITIONS, seconds=EXCERPT_SECONDS):
+    # Start times of the excerpt windows, or None when they would cover most of the track anyway
+    if duration <= len(positions) * seconds * 1.5:
+        return None
+    return [min(max(0.0, position * duration - seconds / 2), duration - seconds) for position in positions]
+
+def extract_features_excerpts(audio_file, offsets, seconds=EXCERPT_SECONDS, duration=None, skip=(),
+                              features=FEATURES, timings=None, sr=TARGET_SR, res_type=DEFAULT_RES_TYPE,
+                              decoder='librosa'):
+    # Features of the concatenated excerpts. Duration comes from the file metadata and energy,
+    # a whole-signal sum, is extrapolated from the excerpts to the full length.
+    timings = {} if timings is None else timings
+    duration = audio_duration(audio_file) if duration is None else duration
+    excerpts = [load_audio(audio_file, timings, sr, res_type, decoder, offset, seconds)[0] for offset in offsets]
+    y = np.concatenate(excerpts)
+    result = extract_features(y, sr, skip, features, timings)
+    if 'duration' in features:
+        result['duration_librosa'] = result['duration_essentia'] = duration
+    if 'energy' in features and len(y):
+        result['energy'] *= duration * sr / len(y)
+    return result
+
+def fingerprint(audio_file, duration, timings=None):
+    # Hex string of (FINGERPRINT_BANDS - 1) * (FINGERPRINT_SLICES - 1) bits, or None for tracks under
+    # a second and for windows too quiet or too uniform to tell tracks apart
+    offset = max(0.0, min(duration - FINGERPRINT_SECONDS, FINGERPRINT_POSITION * duration - FINGERPRINT_SECONDS / 2))
+    y, sr = load_audio(audio_file, {} if timings is None else timings, FINGERPRINT_SR, 'soxr_qq', 'librosa',
+                       offset, FINGERPRINT_SECONDS)
+    if len(y) < FINGERPRINT_SR:
+        return None
+    power = np.abs(librosa.stft(y, n_fft=FRAME_LENGTH, hop_length=HOP_LENGTH)) ** 2
+    bins = np.searchsorted(librosa.fft_frequencies(sr=sr, n_fft=FRAME_LENGTH),
+                           np.geomspace(300, 3000, FINGERPRINT_BANDS + 1))
+    bands = np.add.reduceat(power, bins[:-1], axis=0)[:FINGERPRINT_BANDS]
+    if bands.sum(axis=0).mean() < FINGERPRINT_MIN_BAND_POWER:
+        return None
+    slices = np.array([part.mean(axis=1) for part in np.array_split(bands, FINGERPRINT_SLICES, axis=1)]).T
+    energy = np.log(slices + 1e-10)
+    band_difference = energy[:-1] - energy[1:]
+    bits = (band_difference[:, 1:] - band_difference[:, :-1]) > 0
+    if not FINGERPRINT_MIN_BIT_FRACTION <= bits.mean() <= 1 - FINGERPRINT_MIN_BIT_FRACTION:
+        return None
+    return np.packbits(bits).tobytes().hex()
+
+def read_tags(audio_file):
+    # TAG_COLUMNS values from the file's embedded tags, multiple values joined with '; '.
+    # Without mutagen, or for an untagged or unreadable file, there are none.
+    if mutagen is None:
+        return {}
+    try:
+        audio = mutagen.File(audio_file, easy=True)
+    except mutagen.MutagenError:
+        return {}
+    if audio is None or audio.tags is None:
+        return {}
+    tags = {}
+    for column in TAG_COLUMNS:
+        try:
+            values = audio.tags.get(column)
+        except (KeyError, ValueError):
+            values = None
+        if values:
+            tags[column] = '; '.join(str(value) for value in values)
+    return tags
@@ -0,0 +1,91 @@
+from collections import deque
+import numpy as np
+
+# Auto-DJ: picks each next track from the current track's nearest neighbours. The neighbour graph is
+# filled in as tracks are visited (one k-d tree query each) and kept, so a pick is O(k) once warm.
+# A track qualifies when its tempo is within the BPM window of the current one (at half, equal or
+# double time) and it has not played in the last no_repeat tracks; among those, the cost combines
+# feature distance, tempo drift and the step away from the target energy trend.
+DJ_NEIGHBOURS = 32
+DJ_BPM_WINDOW = 0.06
+DJ_NO_REPEAT = 50
+DJ_TEMPO_WEIGHT = 1.0
+DJ_ENERGY_WEIGHT = 2.0
+TEMPO_MULTIPLES = np.array([0.5, 1.0, 2.0])
+
+class AutoDJ:
+    # Endless track sequence for PlaybackQueue: indexing past the end picks the next track.
+
+    def __init__(self, index, start_file, bpm_window=DJ_BPM_WINDOW, no_repeat=DJ_NO_REPEAT,
+                 energy_trend=0.0, k=DJ_NEIGHBOURS, seed=None):
+        # energy_trend is the wanted change in log energy per track: 0 holds the level, > 0 builds up
+        self.index = index
+        self.k = k
+        self.bpm_window = bpm_window
+        self.energy_trend = energy_trend
+        self.graph = {}
+        self.rng = np.random.default_rng(seed)
+        self.history = [index.positions[start_file]]
+        # A library smaller than the window would run out of tracks, so leave at least one playable
+        self.recent = deque(self.history, maxlen=max(min(no_repeat, len(index.files) - 1), 0))
+
+    def neighbours(self, position):
+        # (neighbour positions, distances) of a track, closest first, without the track itself
+        if position not in self.graph:
+            vectors = self.index.vectors
+            count = min(self.k + 1, len(vectors))
+            if self.index.tree is not None:
+                distances, nearest = self.index.tree.query(vectors[position], k=count)
+                nearest, distances = np.atleast_1d(nearest), np.atleast_1d(distances)
+            else:
+                distances = np.sqrt(np.einsum('ij,ij->i', vectors - vectors[position], vectors - vectors[position]))
+                nearest = np.argpartition(distances, count - 1)[:count]
+                nearest = nearest[np.argsort(distances[nearest])]
+                distances = distances[nearest]
+            keep = nearest != position
+            self.graph[position] = (nearest[keep][:self.k], distances[keep][:self.k])
+        return self.graph[position]
+
+    def __len__(self):
+        # There is always one more track
+        return len(self.history) + 1
+
+    def __getitem__(self, position):
+        while position >= len(self.history):
+            self.history.append(self.pick_next())
+            self.recent.append(self.history[-1])
+        return self.index.files[self.history[position]]
+
+    def costs(self, current, candidates, distances):
+        tempo = self.index.tempo
+        if tempo[current] > 0:
+            # Closest of half, equal and double time, as a fraction of the current tempo
+            drift = np.abs(tempo[candidates, None] * TEMPO_MULTIPLES - tempo[current]).min(axis=1) / tempo[current]
+        else:
+            drift = np.zeros(len(candidates))
+        energy_step = self.index.log_energy[candidates] - self.index.log_energy[current] - self.energy_trend
+        cost = distances + DJ_TEMPO_WEIGHT * drift / self.bpm_window + DJ_ENERGY_WEIGHT * np.abs(energy_step)
+        cost[drift > self.bpm_window] = np.inf
+        cost[np.isin(candidates, np.fromiter(self.recent, dtype=np.int64))] = np.inf
+        cost[candidates == current] = np.inf
+        return cost
+
+    def pick_next(self):
+        current = self.history[-1]
+        if len(self.index.files) == 1:
+            # Nothing else to play
+            return current
+        candidates, distances = self.neighbours(current)
+        cost = self.costs(current, candidates, distances)
+        if np.isfinite(cost).any():
+            return int(candidates[np.argmin(cost)])
+        # Dead end: every neighbour is out of tempo range or played recently. Try the neighbours'
+        # neighbours, then any track that has not played recently.
+        second = [self.neighbours(candidate)[0] for candidate in candidates]
+        second = np.concatenate(second) if second else np.zeros(0, dtype=np.int64)
+        cost = self.costs(current, second, np.zeros(len(second)))
+        if np.isfinite(cost).any():
+            return int(second[np.argmin(cost)])
+        recent = np.fromiter(self.recent, dtype=np.int64)
+        unplayed = np.setdiff1d(np.arange(len(self.index.files)), np.append(recent, current))
+        return int(self.rng.choice(unplayed))
@@ -0,0 +1,313 @@
+import os
+import argparse
+import glob
+import json
+import platform
+import shutil
+import statistics
+import tempfile
+import time
+import numpy as np
+import soundfile
+from analyze_audio_max import analyze_audio_file
+from audio_features import PROFILES, ffmpeg_available
+from feature_store import open_store, track_values, write_tracks, CONTRAST_BANDS
+from player_library import open_library, rebuild_library
+from library_query import LibraryTable
+from playlist_filter import load_feature_table, compile_filters, filter_files
+from similarity import SimilarityIndex
+
+# Throughput benchmarks for analysis, library loading, filtering and the similar-tracks query.
+# Every fixture is synthesized locally; results are written as JSON and compared against a baseline
+# file so a slowdown shows up as a ratio instead of a number nobody remembers.
+AUDIO_KINDS = ('sine', 'noise', 'clicks')
+AUDIO_SECONDS = (10, 30, 90)
+# CD rate, so the analyzer resamples like it does for most real libraries
+FIXTURE_SR = 44100
+# Decoding options compared against the default (22050 Hz, soxr_hq, librosa) for speed and feature drift
+DECODING_OPTIONS = {
+    'soxr_lq': {'res_type': 'soxr_lq'},
+    'sr11025': {'sr': 11025},
+    'sr11025_soxr_qq': {'sr': 11025, 'res_type': 'soxr_qq'},
+    'ffmpeg': {'decoder': 'ffmpeg'},
+    'ffmpeg_sr11025': {'decoder': 'ffmpeg', 'sr': 11025},
+}
+DRIFT_FEATURES = ('tempo_librosa', 'duration_librosa', 'zero_crossings_librosa', 'energy', 'danceability')
+DEFAULT_ROWS = '1000,10000,100000'
+SIMILARITY_QUERIES = 200
+# Search bar queries, from narrow numeric ranges to substrings matching half the library and a misspelling
+SEARCH_QUERIES = ('tempo:120..128', 'tempo:120..128 energy:>30000', 'duration:<=3:00 dance:>2',
+                  'name:"track 12"', 'artist 5', '-name:"track 1" bpm:>100', 'track 777', 'trak 7771')
+REGRESSION_THRESHOLD = 1.2
+# Every timing is the best of this many runs, so a one-off stall does not read as a slowdown
+DEFAULT_REPEATS = 3
+# Durations below these, by unit, are within timer and scheduler noise, so compare() does not rate them
+NOISE_FLOORS = {'ms': 1.0, 'seconds': 0.1}
+
+def synth_audio(kind, seconds, sr=FIXTURE_SR, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sr)) / sr
+    if kind == 'sine':
+        y = 0.5 * np.sin(2 * np.pi * 440 * t) * (0.6 + 0.4 * np.sin(2 * np.pi * 0.25 * t))
+    elif kind == 'noise':
+        y = 0.3 * rng.standard_normal(len(t))
+    else:
+        # 120 BPM click track so the tempo extractors have beats to find
+        y = 0.05 * rng.standard_normal(len(t))
+        for start in range(0, len(t), sr // 2):
+            y[start:start + 200] += np.hanning(min(200, len(t) - start))
+    return y.astype(np.float32)
+
+def write_audio_fixtures(directory):
+    files = []
+    for kind in AUDIO_KINDS:
+        for seconds in AUDIO_SECONDS:
+            path = os.path.join(directory, f'{kind}_{seconds}s.wav')
+            soundfile.write(path, synth_audio(kind, seconds), FIXTURE_SR)
+            files.append((path, seconds))
+    return files
+
+def synth_records(rows, seed=0):
+    # Feature values spread over realistic ranges
+    rng = np.random.default_rng(seed)
+    tempo = rng.uniform(60, 180, rows)
+    duration = rng.uniform(60, 600, rows)
+    zcr = rng.uniform(0.02, 0.25, rows)
+    danceability = rng.uniform(0.5, 3.0, rows)
+    energy = rng.lognormal(10, 2, rows)
+    contrast = rng.uniform(10, 50, (rows, CONTRAST_BANDS))
+    for i in range(rows):
+        yield {'filename': f'artist {i % 997} - track {i}.mp3',
+               'tempo_librosa': tempo[i], 'tempo_essentia': tempo[i] + 1.5,
+               'duration_librosa': duration[i], 'duration_essentia': duration[i],
+               'zero_crossings_librosa': zcr[i], 'zero_crossing_rate': zcr[i] * 0.85,
+               'danceability': danceability[i], 'energy': energy[i],
+               'spectral_contrast_librosa': contrast[i].tolist()}
+
+def write_scanned_db(text_file, rows):
+    # Same layout as the legacy analyzer output, including the danceability DFA array
+    with open(text_file, 'w') as f:
+        for record in synth_records(rows):
+            f.write(f"File: {record['filename']}\n"
+                    f"  Tempo (Librosa): [{record['tempo_librosa']}] BPM\n"
+                    f"  Duration (Librosa): {record['duration_librosa']} seconds\n"
+                    f"  Zero Crossing Rate (Librosa): {record['zero_crossings_librosa']}\n"
+                    f"  Spectral Contrast (Librosa): {record['spectral_contrast_librosa']}\n"
+                    f"  Danceability (Essentia): ({record['danceability']}, array([0.4321221 , 0.2879549 ,\n"
+                    f"       0.21618605, 0.25037906], dtype=float32))\n"
+                    f"  Energy (Essentia): {record['energy']}\n"
+                    f"  Tempo (Essentia): {record['tempo_essentia']} BPM\n"
+                    f"  Duration (Essentia): {record['duration_essentia']} seconds\n"
+                    f"  Zero Crossing Rate (Essentia): {record['zero_crossing_rate']}\n\n")
+
+def write_feature_store(store_file, rows, directory):
+    conn = open_store(store_file)
+    batch = []
+    for record in synth_records(rows):
+        batch.append(track_values(os.path.join(directory, record['filename']), {}, record))
+        if len(batch) >= 10000:
+            write_tracks(conn, batch)
+            batch = []
+    write_tracks(conn, batch)
+    conn.close()
+
+def timed_call(function, *args):
+    start = time.perf_counter()
+    value = function(*args)
+    return time.perf_counter() - start, value
+
+def best_of(repeats, function, *args, setup=None):
+    # Shortest time of several runs, and the value of the last one; setup() runs untimed before each
+    best = np.inf
+    for _ in range(repeats):
+        if setup:
+            setup()
+        elapsed, value = timed_call(function, *args)
+        best = min(best, elapsed)
+    return best, value
+
+def clear_parse_cache(text_file):
+    for parsed in glob.glob(glob.escape(text_file) + '.parsed-*.npy'):
+        os.remove(parsed)
+
+def analyze_fixtures(audio_files, features, decoding=None, repeats=DEFAULT_REPEATS):
+    seconds = 0.0
+    results = []
+    for path, _ in audio_files:
+        elapsed, (result, error) = best_of(repeats, lambda: analyze_audio_file(path, (), None, features,
+                                                                                **(decoding or {})))
+        if error:
+            raise RuntimeError(f'Analysis of {path} failed: {error}')
+        seconds += elapsed
+        results.append(result)
+    return seconds, results
+
+def bench_analysis(audio_files, profile, repeats=DEFAULT_REPEATS):
+    seconds, _ = analyze_fixtures(audio_files, PROFILES[profile], repeats=repeats)
+    audio_seconds = sum(length for _, length in audio_files)
+    return {'tracks_per_s': len(audio_files) / seconds, 'audio_seconds_per_s': audio_seconds / seconds,
+            'seconds': seconds, 'tracks': len(audio_files)}
+
+def bench_decoding(audio_files, repeats=DEFAULT_REPEATS):
+    # Speedup over the default decode path, and the mean relative drift of each feature from the default values
+    default_seconds, default_results = analyze_fixtures(audio_files, PROFILES['full'], repeats=repeats)
+    results = {}
+    for name, decoding in DECODING_OPTIONS.items():
+        if decoding.get('decoder') == 'ffmpeg' and not ffmpeg_available():
+            print(f'Skipping {name}: ffmpeg is not on the PATH')
+            continue
+        print(f'Decoding option {name}...')
+        seconds, option_results = analyze_fixtures(audio_files, PROFILES['full'], decoding, repeats)
+        metrics = {'speedup': default_seconds / seconds}
+        for feature in DRIFT_FEATURES:
+            drift = [abs(option[feature] - default[feature]) / abs(default[feature])
+                     for option, default in zip(option_results, default_results) if default[feature]]
+            metrics[f'drift_{feature}'] = float(np.mean(drift)) if drift else 0.0
+        results[f'decoding.{name}'] = metrics
+    return results
+
+def bench_library_load(workdir, source_file, repeats=DEFAULT_REPEATS):
+    # A text source is parsed from scratch every run, not read back from the parse cache
+    library_file = os.path.join(workdir, 'library.sqlite')
+    conn = open_library(library_file)
+    elapsed, _ = best_of(repeats, rebuild_library, conn, source_file, workdir,
+                         setup=lambda: clear_parse_cache(source_file))
+    rows = conn.execute('SELECT COUNT(*) FROM playlist').fetchone()[0]
+    conn.close()
+    return {'seconds': elapsed, 'rows_per_s': rows / elapsed}, library_file
+
+def bench_filter(source_file, repeats=DEFAULT_REPEATS):
+    # load_seconds parses a text source from scratch, like the first filter after it changes;
+    # cached_load_seconds reads the parse cache that run leaves behind
+    load_seconds, _ = best_of(repeats, load_feature_table, source_file,
+                              setup=lambda: clear_parse_cache(source_file))
+    cached_load_seconds, table = best_of(repeats, load_feature_table, source_file)
+    bounds = compile_filters({'tempo': (118, 130), 'energy': (1000, None), 'danceability': (1.0, 2.5)})
+    runs = [timed_call(filter_files, table, bounds, '-energy')[0] for _ in range(20)]
+    return {'load_seconds': load_seconds, 'cached_load_seconds': cached_load_seconds,
+            'filter_ms': statistics.median(runs) * 1000}
+
+def bench_search(library_file, repeats=DEFAULT_REPEATS):
+    # Each query re-sorted by tempo, the way the player asks for it, after the sort order is cached;
+    # a query's latency is its best of five runs
+    conn = open_library(library_file)
+    load_seconds, table = best_of(repeats, LibraryTable.from_library, conn)
+    table.query('', 2, False)
+    latencies = sorted(best_of(5, table.query, query, 2, False)[0] * 1000 for query in SEARCH_QUERIES)
+    conn.close()
+    return {'load_seconds': load_seconds, 'query_ms_p50': latencies[len(latencies) // 2],
+            'query_ms_max': latencies[-1]}
+
+def bench_similarity(library_file, repeats=DEFAULT_REPEATS):
+    conn = open_library(library_file)
+    build_seconds, index = best_of(repeats, SimilarityIndex.from_library, conn)
+    conn.close()
+    files = list(index.positions)
+    rng = np.random.default_rng(0)
+    queries = [files[i] for i in rng.integers(0, len(files), min(SIMILARITY_QUERIES, len(files)))]
+    latencies = sorted(best_of(repeats, index.neighbours, file)[0] * 1000 for file in queries)
+    return {'build_seconds': build_seconds, 'query_ms_p50': latencies[len(latencies) // 2],
+            'query_ms_p95': latencies[int(len(latencies) * 0.95)]}
+
+def run_benchmarks(workdir, row_counts, profiles, skip_audio=False, decoding=False, repeats=DEFAULT_REPEATS):
+    results = {}
+    if not skip_audio:
+        audio_files = write_audio_fixtures(workdir)
+        for profile in profiles:
+            print(f'Analysis, profile {profile}...')
+            results[f'analysis.{profile}'] = bench_analysis(audio_files, profile, repeats)
+        if decoding:
+            results.update(bench_decoding(audio_files, repeats))
+    for rows in row_counts:
+        text_file = os.path.join(workdir, f'scanned_db_{rows}.txt')
+        store_file = os.path.join(workdir, f'scanned_db_{rows}.sqlite')
+        print(f'Synthesizing {rows} rows...')
+        write_scanned_db(text_file, rows)
+        write_feature_store(store_file, rows, workdir)
+        for kind, source_file in (('text', text_file), ('store', store_file)):
+            print(f'Library load and filters from {kind}, {rows} rows...')
+            results[f'library_load.{kind}.{rows}'], library_file = bench_library_load(workdir, source_file, repeats)
+            results[f'filter.{kind}.{rows}'] = bench_filter(source_file, repeats)
+        print(f'Search, {rows} rows...')
+        results[f'search.{rows}'] = bench_search(library_file, repeats)
+        print(f'Similarity, {rows} rows...')
+        results[f'similarity.{rows}'] = bench_similarity(library_file, repeats)
+        clear_parse_cache(text_file)
+        os.remove(text_file)
+    return results
+
+# Metrics where a larger value is better; every other metric is a duration or a drift
+HIGHER_IS_BETTER = ('tracks_per_s', 'audio_seconds_per_s', 'rows_per_s', 'speedup')
+
+def noise_floor(metric):
+    return max((floor for unit, floor in NOISE_FLOORS.items() if unit in metric.split('_')), default=0.0)
+
+def compare(results, baseline):
+    # Returns (benchmark, metric, baseline, current, slowdown) for every shared metric above its noise floor;
+    # slowdown > 1 means the current run is slower
+    comparisons = []
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            old = baseline.get(name, {}).get(metric)
+            if metric == 'tracks' or not old or not value:
+                continue
+            if metric in HIGHER_IS_BETTER:
+                # A rate is as noisy as the duration it was computed from
+                durations, floor = (baseline[name].get('seconds'), metrics.get('seconds')), NOISE_FLOORS['seconds']
+            else:
+                durations, floor = (old, value), noise_floor(metric)
+            if None not in durations and max(durations) < floor:
+                continue
+            slowdown = old / value if metric in HIGHER_IS_BETTER else value / old
+            comparisons.append((name, metric, old, value, slowdown))
+    return comparisons
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark analysis, library loading, filtering and similarity.')
+    parser.add_argument('--rows', type=str, default=DEFAULT_ROWS,
+                        help='Comma-separated synthetic library sizes, e.g. 1000,100000,1000000.')
+    parser.add_argument('--profile', action='append', choices=sorted(PROFILES), default=[],
+                        help='Analysis profile to benchmark (repeatable, default: all).')
+    parser.add_argument('--decoding', action='store_true',
+                        help='Also compare the faster decoding options against the default for speed and accuracy.')
+    parser.add_argument('--skip-audio', action='store_true', help='Skip the audio analysis benchmark.')
+    parser.add_argument('--output', type=str, default='benchmark_results.json', help='Where to write the results.')
+    parser.add_argument('--baseline', type=str, default=None, help='Earlier results file to compare against.')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help='Slowdown ratio against the baseline reported as a regression.')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEATS,
+                        help='Runs per measurement; the best one is kept.')
+    parser.add_argument('--workdir', type=str, default=None, help='Directory for fixtures (default: a temporary one).')
+    args = parser.parse_args()
+
+    row_counts = [int(rows) for rows in args.rows.split(',') if rows.strip()]
+    workdir = args.workdir or tempfile.mkdtemp(prefix='plai-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        results = run_benchmarks(workdir, row_counts, args.profile or sorted(PROFILES), args.skip_audio,
+                                 args.decoding, max(args.repeat, 1))
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump({'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'machine': platform.platform(),
+                   'python': platform.python_version(), 'cpus': os.cpu_count(), 'repeats': args.repeat, 'results': results}, f, indent=2)
+    for name, metrics in results.items():
+        print(f"{name:32} " + '  '.join(f'{metric}={value:.4g}' for metric, value in metrics.items()))
+    print(f'Results written to {args.output}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = 0
+        for name, metric, old, new, slowdown in compare(results, baseline):
+            flag = 'REGRESSION' if slowdown > args.threshold else ''
+            regressions += bool(flag)
+            print(f'{name:32} {metric:20} {old:10.4g} -> {new:10.4g}  x{slowdown:.2f} {flag}')
+        print(f'{regressions} regressions against {args.baseline}')
+        if regressions:
+            raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
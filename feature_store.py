@@ -0,0 +1,323 @@
+import os
+import argparse
+import sqlite3
+import time
+import mmap
+from urllib.request import pathname2url
+import numpy as np
+from legacy_db import CONTRAST_BANDS, load_legacy_db, iter_records, resolve_paths
+
+# On-disk feature store written by analyze_audio_max.py and read by the player and the M3U generator.
+# Bump STORE_SCHEMA_VERSION and add a MIGRATIONS step whenever the schema changes.
+STORE_SCHEMA_VERSION = 6
+CONTRAST_COLUMNS = [f'contrast_{i}' for i in range(CONTRAST_BANDS)]
+FEATURE_COLUMNS = [
+    'tempo_librosa', 'tempo_essentia',
+    'duration_librosa', 'duration_essentia',
+    'zero_crossings_librosa', 'zero_crossing_rate',
+    'danceability', 'energy',
+] + CONTRAST_COLUMNS
+# Embedded tags, read once per file during analysis
+TAG_COLUMNS = ['artist', 'album', 'title', 'genre']
+SQLITE_HEADER = b'SQLite format 3\x00'
+# Two fingerprints match when at most this fraction of their bits differ (unrelated tracks sit near 0.5)
+# and the durations are this many seconds apart at most
+FINGERPRINT_MAX_DISTANCE = 0.25
+DUPLICATE_DURATION_TOLERANCE = 1.5
+# Fingerprints with fewer than this fraction of ones or of zeros come from (near) silence and match anything
+FINGERPRINT_MIN_BIT_FRACTION = 0.1
+
+def is_feature_store(path):
+    with open(path, 'rb') as f:
+        return f.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+
+def create_tracks_table(conn):
+    columns = ', '.join(f'{column} REAL' for column in FEATURE_COLUMNS)
+    conn.execute(f'''CREATE TABLE IF NOT EXISTS tracks
+                    (path TEXT PRIMARY KEY, filename TEXT NOT NULL,
+                    size INTEGER, mtime REAL, content_hash TEXT, {columns})''')
+
+def create_jobs_table(conn):
+    # Analysis journal: per-file state so an interrupted scan can resume and bad files are quarantined
+    conn.execute('''CREATE TABLE IF NOT EXISTS jobs
+                    (path TEXT PRIMARY KEY, state TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0,
+                    error TEXT, size INTEGER, mtime REAL, updated REAL)''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs (state)')
+
+def create_timelines_table(conn):
+    # Index into the <store>.timeline file: where each track's timeline starts and how long its arrays are
+    conn.execute('''CREATE TABLE IF NOT EXISTS timelines
+                    (path TEXT PRIMARY KEY, offset INTEGER NOT NULL, duration REAL, rms_points INTEGER,
+                    energy_seconds INTEGER, beat_count INTEGER, rms_peak REAL, energy_peak REAL)''')
+
+def add_fingerprint_columns(conn):
+    # duplicate_of is the path of the track whose features a duplicate reuses
+    conn.execute('ALTER TABLE tracks ADD COLUMN fingerprint TEXT')
+    conn.execute('ALTER TABLE tracks ADD COLUMN duplicate_of TEXT')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_tracks_duration ON tracks (duration_librosa)')
+
+def add_tag_columns(conn):
+    for column in TAG_COLUMNS:
+        conn.execute(f'ALTER TABLE tracks ADD COLUMN {column} TEXT')
+
+def add_profile_column(conn):
+    # Analysis profile a track was written with. Earlier rows are told apart by the features only
+    # the fast profile leaves out.
+    conn.execute('ALTER TABLE tracks ADD COLUMN profile TEXT')
+    conn.execute('''UPDATE tracks SET profile = CASE WHEN tempo_librosa IS NULL AND danceability IS NULL
+                    THEN 'fast' ELSE 'full' END''')
+
+# MIGRATIONS[n] upgrades a store from schema version n - 1 to n
+MIGRATIONS = {1: create_tracks_table, 2: create_jobs_table, 3: create_timelines_table, 4: add_fingerprint_columns,
+              5: add_tag_columns, 6: add_profile_column}
+
+def open_store_readonly(path, **kwargs):
+    # The path is percent-encoded so names containing '#' or '?' are not read as URI parts
+    return sqlite3.connect('file:' + pathname2url(os.path.abspath(path)) + '?mode=ro', uri=True, **kwargs)
+
+def open_store(path, timeout=60):
+    conn = sqlite3.connect(path, timeout=timeout)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+    row = conn.execute("SELECT value FROM meta WHERE key = 'schema_version'").fetchone()
+    version = int(row['value']) if row else 0
+    if version > STORE_SCHEMA_VERSION:
+        conn.close()
+        raise ValueError(f'{path} has feature store schema version {version}, '
+                         f'expected at most {STORE_SCHEMA_VERSION}')
+    if version < STORE_SCHEMA_VERSION:
+        with conn:
+            for step in range(version + 1, STORE_SCHEMA_VERSION + 1):
+                MIGRATIONS[step](conn)
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('schema_version', ?)", (str(STORE_SCHEMA_VERSION),))
+    return conn
+
+def track_values(path, signature, result):
+    contrast = list(result.get('spectral_contrast_librosa', []))[:CONTRAST_BANDS]
+    contrast += [None] * (CONTRAST_BANDS - len(contrast))
+    return ([path, os.path.basename(path), signature.get('size'), signature.get('mtime'), signature.get('hash')]
+            + [result.get(column) for column in FEATURE_COLUMNS[:-CONTRAST_BANDS]] + contrast
+            + [result.get('fingerprint'), result.get('duplicate_of')]
+            + [result.get('tags', {}).get(column) for column in TAG_COLUMNS] + [result.get('profile')])
+
+def stored_result(row):
+    # A tracks row back in the shape analyze_audio_file returns
+    result = {column: row[column] for column in FEATURE_COLUMNS[:-CONTRAST_BANDS] if row[column] is not None}
+    result['spectral_contrast_librosa'] = [row[column] for column in CONTRAST_COLUMNS if row[column] is not None]
+    result['profile'] = row['profile']
+    return result
+
+def write_tracks(conn, rows):
+    # Track rows and their 'done' journal entries are committed in the same transaction
+    placeholders = ', '.join('?' * (8 + len(FEATURE_COLUMNS) + len(TAG_COLUMNS)))
+    with conn:
+        conn.executemany(f'INSERT OR REPLACE INTO tracks VALUES ({placeholders})', rows)
+        conn.executemany("UPDATE jobs SET state = 'done', error = NULL, updated = ? WHERE path = ?",
+                         [(time.time(), row[0]) for row in rows])
+
+def delete_tracks(conn, paths):
+    with conn:
+        conn.executemany('DELETE FROM tracks WHERE path = ?', [(path,) for path in paths])
+        conn.executemany('DELETE FROM jobs WHERE path = ?', [(path,) for path in paths])
+        conn.executemany('DELETE FROM timelines WHERE path = ?', [(path,) for path in paths])
+        # Duplicates of a removed track keep their copied features and stand on their own
+        conn.executemany('UPDATE tracks SET duplicate_of = NULL WHERE duplicate_of = ?', [(path,) for path in paths])
+
+def clear_tracks(conn):
+    with conn:
+        conn.execute('DELETE FROM tracks')
+        conn.execute('DELETE FROM jobs')
+        conn.execute('DELETE FROM timelines')
+
+def timeline_file(store_file):
+    return store_file + '.timeline'
+
+def write_timelines(conn, timeline_path, timelines):
+    # Each timeline is appended as float32 beat times, then the RMS envelope and per-second energy as
+    # float16 fractions of their peaks, padded to 4 bytes; a 6 minute track takes about 4 KB.
+    # A re-analyzed track gets a new record and the old bytes are left unused until the next --full scan.
+    rows = []
+    with open(timeline_path, 'ab') as f:
+        for path, timeline in timelines:
+            rms_peak = float(timeline['rms'].max(initial=0.0)) or 1.0
+            energy_peak = float(timeline['energy'].max(initial=0.0)) or 1.0
+            data = (timeline['beats'].astype(np.float32).tobytes()
+                    + (timeline['rms'] / rms_peak).astype(np.float16).tobytes()
+                    + (timeline['energy'] / energy_peak).astype(np.float16).tobytes())
+            offset = f.tell()
+            f.write(data + b'\0' * (-len(data) % 4))
+            rows.append((path, offset, timeline['duration'], len(timeline['rms']), len(timeline['energy']),
+                         len(timeline['beats']), rms_peak, energy_peak))
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO timelines VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+class TimelineReader:
+    # Read-only access to the timelines of a feature store. The timeline file is memory-mapped,
+    # so fetching a track's timeline is an index lookup plus a few array views.
+
+    def __init__(self, store_file):
+        self.conn = open_store_readonly(store_file, check_same_thread=False)
+        self.path = timeline_file(store_file)
+        self.file = None
+        self.map = None
+
+    def get(self, path):
+        try:
+            row = self.conn.execute('''SELECT offset, duration, rms_points, energy_seconds, beat_count,
+                                       rms_peak, energy_peak FROM timelines WHERE path = ?''', (path,)).fetchone()
+        except sqlite3.OperationalError:
+            # A store written before timelines existed
+            return None
+        if row is None:
+            # A duplicate shares the timeline of the track it was copied from
+            original = self.conn.execute('SELECT duplicate_of FROM tracks WHERE path = ?', (path,)).fetchone()
+            return self.get(original[0]) if original and original[0] else None
+        offset, duration, rms_points, energy_seconds, beat_count, rms_peak, energy_peak = row
+        end = offset + 4 * beat_count + 2 * (rms_points + energy_seconds)
+        if self.map is None or len(self.map) < end:
+            # The analyzer may have appended since the file was mapped
+            self.close_map()
+            if not os.path.exists(self.path) or os.path.getsize(self.path) < end:
+                return None
+            self.file = open(self.path, 'rb')
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        beats = np.frombuffer(self.map, np.float32, beat_count, offset)
+        offset += 4 * beat_count
+        rms = np.frombuffer(self.map, np.float16, rms_points, offset)
+        energy = np.frombuffer(self.map, np.float16, energy_seconds, offset + 2 * rms_points)
+        return {'duration': duration, 'beats': beats.copy(), 'rms': rms.astype(np.float32) * rms_peak,
+                'energy': energy.astype(np.float32) * energy_peak}
+
+    def close_map(self):
+        if self.map is not None:
+            self.map.close()
+            self.file.close()
+            self.map = self.file = None
+
+    def close(self):
+        self.close_map()
+        self.conn.close()
+
+def get_job(conn, path):
+    return conn.execute('SELECT * FROM jobs WHERE path = ?', (path,)).fetchone()
+
+def queue_jobs(conn, items, reset_attempts=False):
+    # items are (path, signature); attempts are kept only while the file itself is unchanged
+    now = time.time()
+    if reset_attempts:
+        with conn:
+            conn.executemany('UPDATE jobs SET attempts = 0 WHERE path = ?', [(path,) for path, _ in items])
+    with conn:
+        conn.executemany('''INSERT INTO jobs (path, state, attempts, size, mtime, updated)
+                            VALUES (?, 'pending', 0, ?, ?, ?)
+                            ON CONFLICT (path) DO UPDATE SET
+                            attempts = CASE WHEN size = excluded.size AND mtime = excluded.mtime
+                                       THEN attempts ELSE 0 END,
+                            state = 'pending', size = excluded.size, mtime = excluded.mtime,
+                            updated = excluded.updated''',
+                         [(path, signature['size'], signature['mtime'], now) for path, signature in items])
+
+def set_job_state(conn, paths, state, error=None, attempt=False):
+    with conn:
+        conn.executemany('''UPDATE jobs SET state = ?, error = ?, updated = ?,
+                            attempts = attempts + ? WHERE path = ?''',
+                         [(state, error, time.time(), int(attempt), path) for path in paths])
+
+def job_attempts(conn, path):
+    row = conn.execute('SELECT attempts FROM jobs WHERE path = ?', (path,)).fetchone()
+    return row['attempts'] if row else 0
+
+def recover_interrupted_jobs(conn, max_attempts):
+    # Files left 'running' by a killed scan count as a failed attempt; repeat offenders are quarantined
+    with conn:
+        interrupted = conn.execute("""UPDATE jobs SET state = 'pending', attempts = attempts + 1,
+                                      error = 'interrupted while running' WHERE state = 'running'""").rowcount
+        conn.execute("UPDATE jobs SET state = 'quarantined' WHERE state = 'pending' AND attempts >= ?",
+                     (max_attempts,))
+    return interrupted
+
+def get_signature(conn, path):
+    row = conn.execute('SELECT size, mtime, content_hash, profile FROM tracks WHERE path = ?', (path,)).fetchone()
+    if row is None:
+        return None
+    return {'size': row['size'], 'mtime': row['mtime'], 'hash': row['content_hash'], 'profile': row['profile']}
+
+def set_content_hashes(conn, items):
+    # (path, hash) pairs for tracks stored before content hashes were compared
+    with conn:
+        conn.executemany('UPDATE tracks SET content_hash = ? WHERE path = ?', [(digest, path) for path, digest in items])
+
+def iter_stored_paths(conn, directory):
+    # Paths of analyzed or journaled files below directory
+    prefix = os.path.join(directory, '')
+    return (row[0] for row in conn.execute('''SELECT path FROM tracks WHERE substr(path, 1, ?) = ?
+                                              UNION SELECT path FROM jobs WHERE substr(path, 1, ?) = ?''',
+                                           (len(prefix), prefix, len(prefix), prefix)))
+
+def fingerprint_distance(first, second):
+    # Fraction of differing bits between two hex fingerprints of the same length
+    return bin(int(first, 16) ^ int(second, 16)).count('1') / (4 * len(first))
+
+def fingerprint_is_uniform(fingerprint):
+    ones = bin(int(fingerprint, 16)).count('1') / (4 * len(fingerprint))
+    return not FINGERPRINT_MIN_BIT_FRACTION <= ones <= 1 - FINGERPRINT_MIN_BIT_FRACTION
+
+def find_duplicate(conn, fingerprint, duration, path, profiles=None, max_distance=FINGERPRINT_MAX_DISTANCE,
+                   tolerance=DUPLICATE_DURATION_TOLERANCE):
+    # The closest analyzed track with a matching fingerprint, or None. Only originals are candidates,
+    # so duplicates always point straight at the track that was actually analyzed. profiles limits
+    # them to tracks analyzed with one of those profiles.
+    rows = conn.execute('''SELECT * FROM tracks WHERE duration_librosa BETWEEN ? AND ?
+                           AND fingerprint IS NOT NULL AND duplicate_of IS NULL AND path != ?''',
+                        (duration - tolerance, duration + tolerance, path)).fetchall()
+    if profiles is not None:
+        rows = [row for row in rows if row['profile'] in profiles]
+    best, best_distance = None, max_distance
+    for row in rows:
+        # Stores scanned before uniform fingerprints were rejected may still hold some
+        if len(row['fingerprint']) != len(fingerprint) or fingerprint_is_uniform(row['fingerprint']):
+            continue
+        distance = fingerprint_distance(row['fingerprint'], fingerprint)
+        if distance <= best_distance:
+            best, best_distance = row, distance
+    return best
+
+def iter_duplicates(conn):
+    # (original, duplicate) path pairs, grouped by original
+    return ((row[0], row[1]) for row in conn.execute('''SELECT duplicate_of, path FROM tracks
+                                                        WHERE duplicate_of IS NOT NULL ORDER BY duplicate_of, path'''))
+
+def iter_tracks(conn):
+    return conn.execute('SELECT * FROM tracks ORDER BY filename')
+
+def import_scanned_db(text_file, store_file, audio_directory):
+    conn = open_store(store_file)
+    rows = []
+    records = load_legacy_db(text_file)
+    paths = resolve_paths(records['filename'].tolist(), audio_directory)
+    for record, path in zip(iter_records(records), paths):
+        path = os.path.abspath(path)
+        signature = {}
+        if os.path.exists(path):
+            # The file was analyzed already, so record its signature to keep incremental scans from redoing it
+            stat = os.stat(path)
+            signature = {'size': stat.st_size, 'mtime': stat.st_mtime}
+        # The legacy analyzer extracted every feature
+        rows.append(track_values(path, signature, dict(record, profile='full')))
+    write_tracks(conn, rows)
+    conn.close()
+    return len(rows)
+
+def main():
+    parser = argparse.ArgumentParser(description='Import a legacy scanned_db.txt into a feature store.')
+    parser.add_argument('text_file', type=str, help='Legacy scanned_db.txt to import.')
+    parser.add_argument('audio_directory', type=str, help='Directory containing the analyzed audio files.')
+    parser.add_argument('--output', type=str, default='scanned_db.sqlite', help='Feature store to write.')
+    args = parser.parse_args()
+
+    imported = import_scanned_db(args.text_file, args.output, args.audio_directory)
+    print(f'Imported {imported} tracks from {args.text_file} into {args.output}')
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,8 @@ import gi
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk
 import os
-import numpy as np
+from playlist_filter import (load_feature_table, compile_filters, filter_files, parse_bound,
+                             parse_contrast_bound, write_m3u)
 
 class PlaylistGenerator(Gtk.Window):
     def __init__(self):
@@ -10,6 +11,9 @@ class PlaylistGenerator(Gtk.Window):
         self.set_border_width(10)
         self.set_default_size(800, 600)
 
+        self.table = None
+        self.table_key = None
+
         vbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=6)
         self.add(vbox)
 
@@ -76,113 +80,44 @@ class PlaylistGenerator(Gtk.Window):
             self.show_error("Wybierz plik bazy danych!")
             return
 
-        filtered_tracks = self.filter_tracks(db_file)
+        try:
+            filtered_tracks = self.filter_tracks(db_file)
+        except ValueError as e:
+            self.show_error(f"Niepoprawny filtr: {e}")
+            return
         if filtered_tracks:
             self.generate_m3u(filtered_tracks)
         else:
             self.show_error("Brak utworów spełniających kryteria!")
 
+    def load_table(self, db_file):
+        # The feature table is loaded once per database file and reused for every generated playlist
+        key = (db_file, os.path.getmtime(db_file))
+        if self.table_key != key:
+            self.table = load_feature_table(db_file)
+            self.table_key = key
+        return self.table
+
+    def compile_ui_filters(self):
+        entries = {
+            'tempo': (self.tempo_min, self.tempo_max),
+            'duration': (self.duration_min, self.duration_max),
+            'energy': (self.energy_min, self.energy_max),
+            'danceability': (self.danceability_min, self.danceability_max),
+            'zero_crossing_rate': (self.zcr_min, self.zcr_max),
+        }
+        ranges = {name: (parse_bound(low.get_text()), parse_bound(high.get_text()))
+                  for name, (low, high) in entries.items()}
+        return compile_filters(ranges,
+                               parse_contrast_bound(self.spectral_contrast_min.get_text()),
+                               parse_contrast_bound(self.spectral_contrast_max.get_text()))
+
     def filter_tracks(self, db_file):
-        filtered_tracks = []
-        with open(db_file, 'r') as f:
-            current_track = {}
-            for line in f:
-                line = line.strip()
-                if line.startswith("File:"):
-                    if current_track:
-                        self.process_track(current_track)
-                        if self.track_matches_filters(current_track):
-                            filtered_tracks.append(current_track)
-                    current_track = {"File": line.split(": ", 1)[1]}
-                elif ": " in line:
-                    key, value = line.split(": ", 1)
-                    current_track[key] = value
-
-        if current_track:
-            self.process_track(current_track)
-            if self.track_matches_filters(current_track):
-                filtered_tracks.append(current_track)
-
-        return filtered_tracks
-
-    def process_track(self, track):
-        try:
-            if 'Tempo (Librosa)' in track and 'Tempo (Essentia)' in track:
-                tempo_librosa = float(track['Tempo (Librosa)'].strip('[] BPM'))
-                tempo_essentia = float(track['Tempo (Essentia)'].split()[0])
-                track['Tempo'] = round((tempo_librosa + tempo_essentia) / 2)
-
-            if 'Duration (Librosa)' in track and 'Duration (Essentia)' in track:
-                duration_librosa = float(track['Duration (Librosa)'].split()[0])
-                duration_essentia = float(track['Duration (Essentia)'].split()[0])
-                track['Duration'] = round((duration_librosa + duration_essentia) / 2, 3)
-
-            if 'Zero Crossing Rate (Librosa)' in track and 'Zero Crossing Rate (Essentia)' in track:
-                zcr_librosa = float(track['Zero Crossing Rate (Librosa)'])
-                zcr_essentia = float(track['Zero Crossing Rate (Essentia)'])
-                track['Zero Crossing Rate'] = round((zcr_librosa + zcr_essentia) / 2, 3)
-
-            if 'Spectral Contrast (Librosa)' in track:
-                spectral_contrast_str = track['Spectral Contrast (Librosa)'].strip('[]')
-                track['Spectral Contrast'] = [round(float(x.strip()), 3) for x in spectral_contrast_str.split(',')]
-
-            if 'Danceability (Essentia)' in track:
-                danceability_str = track['Danceability (Essentia)'].split(',')[0]
-                track['Danceability'] = round(float(danceability_str.strip('()')), 3)
-
-            if 'Energy (Essentia)' in track:
-                track['Energy'] = round(float(track['Energy (Essentia)']), 3)
-
-            print(f"Processed track:")
-            for key, value in track.items():
-                print(f"  {key}: {value}")
-        except Exception as e:
-            print(f"Error processing track: {e}")
-            print(f"Problematic track data: {track}")
-
-    def track_matches_filters(self, track):
-        if self.tempo_min.get_text() and track.get('Tempo', 0) < float(self.tempo_min.get_text()):
-            return False
-        if self.tempo_max.get_text() and track.get('Tempo', 0) > float(self.tempo_max.get_text()):
-            return False
-
-        if self.duration_min.get_text() and track.get('Duration', 0) < float(self.duration_min.get_text()):
-            return False
-        if self.duration_max.get_text() and track.get('Duration', 0) > float(self.duration_max.get_text()):
-            return False
-
-        if self.energy_min.get_text() and track.get('Energy', 0) < float(self.energy_min.get_text()):
-            return False
-        if self.energy_max.get_text() and track.get('Energy', 0) > float(self.energy_max.get_text()):
-            return False
-
-        if self.zcr_min.get_text() and track.get('Zero Crossing Rate', 0) < float(self.zcr_min.get_text()):
-            return False
-        if self.zcr_max.get_text() and track.get('Zero Crossing Rate', 0) > float(self.zcr_max.get_text()):
-            return False
-
-        if self.danceability_min.get_text() and track.get('Danceability', 0) < float(self.danceability_min.get_text()):
-            return False
-        if self.danceability_max.get_text() and track.get('Danceability', 0) > float(self.danceability_max.get_text()):
-            return False
-
-        if self.spectral_contrast_min.get_text() or self.spectral_contrast_max.get_text():
-            target_sc_min = np.array([float(x) for x in self.spectral_contrast_min.get_text().split(',')])
-            target_sc_max = np.array([float(x) for x in self.spectral_contrast_max.get_text().split(',')])
-            track_sc = np.array(track.get('Spectral Contrast', []))
-            if len(track_sc) > 0:
-                if np.any(track_sc < target_sc_min) or np.any(track_sc > target_sc_max):
-                    return False
-
-        return True
-
-    def generate_m3u(self, tracks):
+        return filter_files(self.load_table(db_file), self.compile_ui_filters())
+
+    def generate_m3u(self, files):
         playlist_file = "playlist.m3u"
-        with open(playlist_file, 'w') as f:
-            f.write("#EXTM3U\n")
-            for track in tracks:
-                f.write(f"#EXTINF:-1,{os.path.basename(track['File'])}\n")
-                f.write(f"{track['File']}\n")
+        write_m3u(playlist_file, files)
         self.show_info(f"Playlista zapisana jako {playlist_file}")
 
     def show_error(self, message):
@@ -0,0 +1,94 @@
+import os
+import argparse
+import json
+from playlist_filter import (FILTER_FEATURES, load_feature_table, compile_filters, filter_files, parse_bound,
+                             parse_contrast_bound, write_m3u)
+
+# Headless counterpart of fiter_to_m3u.py: same filters, no display needed.
+# A spec file is a JSON list of playlists, e.g.
+#   [{"output": "warmup.m3u", "tempo": [100, 120], "energy_max": 50000, "sort": "tempo"},
+#    {"output": "peak.m3u", "tempo": [125, null], "contrast_min": "15", "sort": "-energy"}]
+# Every playlist is generated from the same feature table, so the database is read only once.
+
+SORT_KEYS = [prefix + key for key in ['filename'] + FILTER_FEATURES for prefix in ('', '-')]
+
+def playlist_filters(spec):
+    ranges = {}
+    for name in FILTER_FEATURES:
+        bounds = spec.get(name) or (None, None)
+        if not isinstance(bounds, (list, tuple)) or len(bounds) != 2:
+            raise ValueError(f'{name} must be a [min, max] pair')
+        low = spec.get(f'{name}_min', bounds[0])
+        high = spec.get(f'{name}_max', bounds[1])
+        ranges[name] = (parse_bound(str(low)) if low is not None else None,
+                        parse_bound(str(high)) if high is not None else None)
+    contrast_min, contrast_max = spec.get('contrast_min'), spec.get('contrast_max')
+    return compile_filters(ranges,
+                           parse_contrast_bound(str(contrast_min)) if contrast_min is not None else None,
+                           parse_contrast_bound(str(contrast_max)) if contrast_max is not None else None)
+
+def check_spec(spec):
+    # Compiled filters of a spec; raises ValueError for anything generate() would trip over
+    if not isinstance(spec, dict):
+        raise ValueError('expected a JSON object')
+    if not spec.get('output'):
+        raise ValueError('no "output" playlist file')
+    if spec.get('sort') and spec['sort'] not in SORT_KEYS:
+        raise ValueError(f"unknown sort key {spec['sort']!r}")
+    return playlist_filters(spec)
+
+def generate(table, spec, bounds):
+    files = filter_files(table, bounds, spec.get('sort'))
+    write_m3u(spec['output'], files)
+    print(f"Wrote {len(files)} tracks to {spec['output']}")
+    return len(files)
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate M3U playlists from an analysis database.')
+    parser.add_argument('database', type=str, help='Feature store or legacy scanned_db.txt.')
+    parser.add_argument('--output', type=str, default='playlist.m3u', help='Playlist file to write.')
+    parser.add_argument('--spec', type=str, help='JSON file describing several playlists to generate.')
+    for name in FILTER_FEATURES:
+        option = name.replace('_', '-')
+        parser.add_argument(f'--{option}-min', type=float, dest=f'{name}_min')
+        parser.add_argument(f'--{option}-max', type=float, dest=f'{name}_max')
+    parser.add_argument('--contrast-min', type=str, help='Spectral contrast minimum: one value or 7 comma-separated.')
+    parser.add_argument('--contrast-max', type=str, help='Spectral contrast maximum: one value or 7 comma-separated.')
+    parser.add_argument('--sort', type=str, choices=SORT_KEYS,
+                        help="Sort key; prefix with '-' for descending order.")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.database):
+        print(f'The database {args.database} does not exist.')
+        raise SystemExit(1)
+
+    if args.spec:
+        try:
+            with open(args.spec, 'r') as f:
+                specs = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f'Cannot read the spec file {args.spec}: {e}')
+            raise SystemExit(1)
+        if not isinstance(specs, list):
+            print(f'The spec file {args.spec} must contain a JSON list of playlists.')
+            raise SystemExit(1)
+    else:
+        specs = [{key: value for key, value in vars(args).items() if value is not None}]
+
+    # Check every spec before writing anything, so a bad entry does not leave a partial set of playlists
+    playlists, errors = [], []
+    for i, spec in enumerate(specs):
+        try:
+            playlists.append((spec, check_spec(spec)))
+        except ValueError as e:
+            errors.append(f'Playlist {i + 1}: {e}')
+    if errors:
+        print('\n'.join(errors))
+        raise SystemExit(1)
+
+    table = load_feature_table(args.database)
+    for spec, bounds in playlists:
+        generate(table, spec, bounds)
+
+if __name__ == '__main__':
+    main()
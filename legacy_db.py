@@ -0,0 +1,141 @@
+import os
+import re
+import mmap
+import glob
+import numpy as np
+
+# Parser for the legacy free-form scanned_db.txt written by older analyzer versions.
+# One compiled regex runs over the memory-mapped file and fills columns, which are then packed into
+# a structured array. The array is cached next to the text file, keyed by its size and mtime, so
+# loading an unchanged file again is a memory-mapped .npy read.
+CONTRAST_BANDS = 7
+LEGACY_FIELDS = {
+    'Tempo (Librosa)': 'tempo_librosa',
+    'Tempo (Essentia)': 'tempo_essentia',
+    'Duration (Librosa)': 'duration_librosa',
+    'Duration (Essentia)': 'duration_essentia',
+    'Zero Crossing Rate (Librosa)': 'zero_crossings_librosa',
+    'Zero Crossing Rate (Essentia)': 'zero_crossing_rate',
+    'Danceability (Essentia)': 'danceability',
+    'Energy (Essentia)': 'energy',
+}
+CONTRAST_FIELD = 'Spectral Contrast (Librosa)'
+LEGACY_COLUMNS = list(LEGACY_FIELDS.values())
+
+# Lines the parser cares about, matched straight from the memory-mapped file; everything else
+# (including the continuation lines of the danceability array) is skipped by the regex engine.
+# Values look like "[117.45] BPM", "181.6 seconds" or "(2.26, array([..." for danceability, so the
+# leading number is captured on its own and the rest of the line separately.
+LINE_RE = re.compile(rb'^[ \t]*(File|' + b'|'.join(re.escape(key.encode()) for key in [*LEGACY_FIELDS, CONTRAST_FIELD])
+                     + rb'): ?([\[(]?)([-+]?[0-9.]+(?:[eE][-+]?[0-9]+)?|nan|inf)?([^\r\n]*)', re.M)
+NUMBER_RE = re.compile(rb'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?|nan|inf')
+FIELD_INDEX = {key.encode(): i for i, key in enumerate(LEGACY_FIELDS)}
+
+def record_dtype(filename_length):
+    # Fixed-width fields only, so the array can be memory-mapped; missing values are NaN
+    return np.dtype([('filename', f'U{max(filename_length, 1)}')]
+                    + [(column, np.float64) for column in LEGACY_COLUMNS]
+                    + [('spectral_contrast', np.float64, (CONTRAST_BANDS,))])
+
+def contrast_values(value):
+    try:
+        values = [float(number) for number in value.strip(b' []').split(b',')]
+    except ValueError:
+        values = [float(number) for number in NUMBER_RE.findall(value)]
+    values = values[:CONTRAST_BANDS]
+    return values + [np.nan] * (CONTRAST_BANDS - len(values))
+
+def parse_legacy_db(text_file):
+    filenames = []
+    values = []
+    contrast = []
+    empty_values = [np.nan] * len(LEGACY_COLUMNS)
+    empty_contrast = [np.nan] * CONTRAST_BANDS
+    row = None
+
+    if os.path.getsize(text_file) > 0:
+        with open(text_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for key, prefix, number, rest in LINE_RE.findall(data):
+                if key == b'File':
+                    filenames.append((prefix + number + rest).strip().decode('utf-8', 'replace'))
+                    row = list(empty_values)
+                    values.append(row)
+                    contrast.append(empty_contrast)
+                elif row is None:
+                    continue
+                elif key in FIELD_INDEX:
+                    if number:
+                        row[FIELD_INDEX[key]] = float(number)
+                else:
+                    contrast[-1] = contrast_values(prefix + number + rest)
+
+    records = np.empty(len(filenames), dtype=record_dtype(max(map(len, filenames), default=1)))
+    records['filename'] = filenames
+    values = np.array(values, dtype=np.float64).reshape(len(filenames), len(LEGACY_COLUMNS))
+    for i, column in enumerate(LEGACY_COLUMNS):
+        records[column] = values[:, i]
+    records['spectral_contrast'] = np.array(contrast, dtype=np.float64).reshape(len(filenames), CONTRAST_BANDS)
+    return records
+
+def cache_file(text_file):
+    stat = os.stat(text_file)
+    return f'{text_file}.parsed-{stat.st_size}-{stat.st_mtime_ns}.npy'
+
+def load_legacy_db(text_file, use_cache=True):
+    # Parsed records of text_file, from the cache when it matches the file's current size and mtime
+    if not use_cache:
+        return parse_legacy_db(text_file)
+    cached = cache_file(text_file)
+    if os.path.exists(cached):
+        try:
+            return np.load(cached, mmap_mode='r')
+        except (OSError, ValueError):
+            pass
+    records = parse_legacy_db(text_file)
+    try:
+        for stale in glob.glob(glob.escape(text_file) + '.parsed-*.npy'):
+            os.remove(stale)
+        tmp_file = cached + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            np.save(f, records)
+        os.replace(tmp_file, cached)
+    except OSError as e:
+        # A read-only music directory just means no cache
+        print(f'Cannot cache parsed {text_file}: {e}')
+    return records
+
+def resolve_paths(filenames, audio_directory):
+    # Legacy records only hold the file's basename, so joining it to audio_directory finds files at the top
+    # level only. Anything else is looked up by name in one walk of the tree; a name found in several
+    # folders is ambiguous and left at the joined path rather than guessed, so the player never plays
+    # the wrong song. The duplicates are reported; re-analyzing into a feature store keys tracks by full path.
+    paths = [os.path.join(audio_directory, filename) for filename in filenames]
+    missing = {os.path.basename(path) for path in paths if not os.path.exists(path)}
+    if not missing:
+        return paths
+    found = {}
+    for root, _, files in os.walk(audio_directory):
+        for name in files:
+            if name in missing:
+                found.setdefault(name, []).append(os.path.join(root, name))
+    ambiguous = 0
+    for i, path in enumerate(paths):
+        matches = found.get(os.path.basename(path), [])
+        if len(matches) == 1 and not os.path.exists(path):
+            paths[i] = matches[0]
+        elif len(matches) > 1:
+            ambiguous += 1
+    if ambiguous:
+        print(f'{ambiguous} legacy entries match files with the same name in several folders and were not resolved')
+    return paths
+
+def iter_records(records):
+    # Dicts in the shape analyze_audio_file returns, without the fields a record has no value for
+    for record in records:
+        result = {'filename': str(record['filename'])}
+        for column in LEGACY_COLUMNS:
+            if not np.isnan(record[column]):
+                result[column] = float(record[column])
+        contrast = record['spectral_contrast']
+        result['spectral_contrast_librosa'] = [float(value) for value in contrast[~np.isnan(contrast)]]
+        yield result
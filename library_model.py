@@ -0,0 +1,116 @@
+from collections import OrderedDict
+import gi
+
+gi.require_version('Gtk', '3.0')
+from gi.repository import Gtk, GObject
+from player_library import fetch_rows
+
+PAGE_SIZE = 256
+CACHED_PAGES = 16
+COLUMN_TYPES = [str, str, float, float, float, float, float, str]
+EMPTY_ROW = tuple('' if column_type is str else 0.0 for column_type in COLUMN_TYPES)
+
+class LibraryModel(GObject.GObject, Gtk.TreeModel):
+    # Flat tree model that reads playlist rows from the library database on demand.
+    # Only the ordered rowids are held in memory; row data is fetched a page at a time
+    # for the rows the view actually asks for, with a small LRU page cache.
+    # rowids may be given already computed, e.g. by a search query run off the main thread.
+
+    def __init__(self, conn, order_by='', rowids=None):
+        GObject.GObject.__init__(self)
+        self.conn = conn
+        if rowids is None:
+            rowids = [row[0] for row in conn.execute(f'SELECT rowid FROM playlist {order_by}')]
+        self.rowids = rowids
+        self.pages = OrderedDict()
+
+    def row(self, index):
+        page = index // PAGE_SIZE
+        rows = self.pages.get(page)
+        if rows is None:
+            # Rows removed by a library reload since this model was built show up empty
+            rows = fetch_rows(self.conn, self.rowids[page * PAGE_SIZE:(page + 1) * PAGE_SIZE], EMPTY_ROW)
+            self.pages[page] = rows
+            if len(self.pages) > CACHED_PAGES:
+                self.pages.popitem(last=False)
+        else:
+            self.pages.move_to_end(page)
+        return rows[index % PAGE_SIZE]
+
+    # GtkTreeIter user_data cannot hold 0, so iterators store index + 1
+    def make_iter(self, index):
+        treeiter = Gtk.TreeIter()
+        treeiter.user_data = index + 1
+        return treeiter
+
+    def iter_index(self, treeiter):
+        return treeiter.user_data - 1
+
+    def do_get_flags(self):
+        return Gtk.TreeModelFlags.LIST_ONLY | Gtk.TreeModelFlags.ITERS_PERSIST
+
+    def do_get_n_columns(self):
+        return len(COLUMN_TYPES)
+
+    def do_get_column_type(self, column):
+        return COLUMN_TYPES[column]
+
+    def do_get_iter(self, path):
+        index = path.get_indices()[0]
+        if 0 <= index < len(self.rowids):
+            return (True, self.make_iter(index))
+        return (False, None)
+
+    def do_get_path(self, treeiter):
+        return Gtk.TreePath((self.iter_index(treeiter),))
+
+    def do_get_value(self, treeiter, column):
+        value = self.row(self.iter_index(treeiter))[column]
+        if value is None:
+            return '' if COLUMN_TYPES[column] is str else 0.0
+        return value
+
+    def do_iter_next(self, treeiter):
+        index = self.iter_index(treeiter) + 1
+        if index < len(self.rowids):
+            treeiter.user_data = index + 1
+            return (True, treeiter)
+        return (False, None)
+
+    def do_iter_previous(self, treeiter):
+        index = self.iter_index(treeiter) - 1
+        if index >= 0:
+            treeiter.user_data = index + 1
+            return (True, treeiter)
+        return (False, None)
+
+    def do_iter_children(self, parent):
+        if parent is None and self.rowids:
+            return (True, self.make_iter(0))
+        return (False, None)
+
+    def do_iter_has_child(self, treeiter):
+        return False
+
+    def do_iter_n_children(self, treeiter):
+        return len(self.rowids) if treeiter is None else 0
+
+    def do_iter_nth_child(self, parent, n):
+        if parent is None and 0 <= n < len(self.rowids):
+            return (True, self.make_iter(n))
+        return (False, None)
+
+    def do_iter_parent(self, child):
+        return (False, None)
+
+class ModelFiles:
+    # Read-only sequence of the file paths in a LibraryModel, in view order, for the playback queue
+
+    def __init__(self, model):
+        self.model = model
+
+    def __len__(self):
+        return len(self.model.rowids)
+
+    def __getitem__(self, index):
+        return self.model.row(index)[0]
@@ -0,0 +1,323 @@
+import re
+import threading
+import numpy as np
+from player_library import PLAYLIST_COLUMNS, TAG_COLUMNS, has_search_index
+
+# Search bar query language for the players.
+#   tempo:120..128   energy:>0.3   duration:<=4:30   danceability:1.5   name:"live remix"   -name:demo
+# Numeric terms take a range (either end optional), a comparison, or a bare value that matches to
+# the precision it is written with (tempo:120 is 119.5 up to 120.5). Text terms match anywhere in the
+# filename (name:), full path (path:) or a tag (artist:, album:, title:, genre:), ignoring case; bare
+# words match any of them. A leading '-' negates a term. When nothing matches, the bare words are
+# retried as a fuzzy search: the tracks sharing the most three-letter sequences with them.
+#
+# Queries run as vectorized masks over the library's columns held in numpy arrays, with one cached
+# argsort per sort column: on 100k tracks a query plus re-sort takes a few milliseconds, where the
+# same query in SQLite takes 20-300 ms depending on whether its index also serves the ORDER BY.
+# Text terms of three or more characters are looked up in the library's FTS5 trigram index when their
+# rarest trigram is selective. Shorter ones, terms that match a large part of the library anyway
+# (a folder every path shares), and every text term when SQLite has no trigram tokenizer, scan the
+# in-memory columns instead, which costs about the same whatever matches.
+NUMERIC_FIELDS = {
+    'tempo': 'tempo', 'bpm': 'tempo',
+    'duration': 'duration', 'length': 'duration',
+    'energy': 'energy',
+    'danceability': 'danceability', 'dance': 'danceability',
+    'zcr': 'zero_crossing_rate',
+}
+TEXT_FIELDS = {'name': 'filename', 'file': 'filename', 'path': 'file', **{column: column for column in TAG_COLUMNS}}
+NUMERIC_COLUMNS = ['tempo', 'duration', 'energy', 'zero_crossing_rate', 'danceability']
+# The spectral contrast text is not held: nothing searches it, and sorting by it is left to SQLite
+TEXT_COLUMNS = ['file', 'filename'] + TAG_COLUMNS
+# Shortest term the trigram index can look up, and how many tracks a fuzzy search returns
+TRIGRAM_LENGTH = 3
+FUZZY_LIMIT = 200
+# Terms whose rarest trigram is in more than this fraction of tracks are scanned instead of looked up;
+# fuzzy searches ignore trigrams that common
+INDEX_MAX_FRACTION = 0.05
+# In a small library that fraction is under one track, so up to this many tracks always counts as rare
+INDEX_MIN_TRACKS = 20
+# What a bare word scans: the path already contains the filename
+SCANNED_COLUMNS = ['file'] + TAG_COLUMNS
+TERM_RE = re.compile(r'(-?)(?:(\w+):)?("[^"]*"?|\S+)')
+COMPARISON_RE = re.compile(r'(<=|>=|<|>|=)?(.+)')
+
+class LibraryTable:
+    # Column snapshot of the library's playlist table, in rowid order. conn is kept for full-text
+    # lookups when indexed (the library has a current search index) and for sorting by columns the
+    # snapshot does not hold; it must only be used from one thread.
+
+    def __init__(self, rowids, numeric, text, conn=None, indexed=False):
+        self.rowids = rowids
+        self.numeric = numeric
+        self.text = text
+        self.conn = conn
+        self.indexed = indexed
+        # Tracks containing each trigram; reading the whole vocabulary once is far cheaper than
+        # counting the common trigrams of every search term
+        self.trigrams = dict(conn.execute('SELECT term, doc FROM playlist_fts_vocab')) if indexed else {}
+        self.haystacks = {}
+        self.orders = {}
+
+    @classmethod
+    def from_library(cls, conn):
+        rows = conn.execute(f"SELECT rowid, {', '.join(NUMERIC_COLUMNS + TEXT_COLUMNS)} FROM playlist ORDER BY rowid").fetchall()
+        columns = list(zip(*rows)) or [()] * (1 + len(NUMERIC_COLUMNS) + len(TEXT_COLUMNS))
+        numeric = {column: np.array(values, dtype=np.float64)
+                   for column, values in zip(NUMERIC_COLUMNS, columns[1:])}
+        text = {column: [value or '' for value in values]
+                for column, values in zip(TEXT_COLUMNS, columns[1 + len(NUMERIC_COLUMNS):])}
+        table = cls(np.array(columns[0], dtype=np.int64), numeric, text, conn, has_search_index(conn))
+        # Built up front, so the first keystroke does not pay for them
+        for column in (SCANNED_COLUMNS if table.indexed else ['filename']):
+            table.haystack(column)
+        return table
+
+    def __len__(self):
+        return len(self.rowids)
+
+    def haystack(self, column):
+        # The column's case-folded values as one UTF-8 byte array, newline separated, with each row's
+        # start offset; substring matches map back to rows with a binary search
+        if column not in self.haystacks:
+            values = [value.lower().replace('\n', ' ').encode() for value in self.text[column]]
+            starts = np.cumsum([0] + [len(value) + 1 for value in values[:-1]], dtype=np.int64)
+            self.haystacks[column] = (np.frombuffer(b'\n'.join(values), np.uint8), starts[:len(values)])
+        return self.haystacks[column]
+
+    def rows_mask(self, rows):
+        # Mask of the rows with the rowids returned by a query
+        mask = np.zeros(len(self), dtype=bool)
+        mask[self.rows_order(rows)] = True
+        return mask
+
+    def common_count(self):
+        # Tracks a trigram is in beyond which it is too common to look up
+        return max(INDEX_MIN_TRACKS, INDEX_MAX_FRACTION * len(self))
+
+    def rows_order(self, rows):
+        # Positions of the rows with the rowids returned by a query, in the query's order
+        rowids = np.fromiter((row[0] for row in rows), dtype=np.int64)
+        positions = np.searchsorted(self.rowids, rowids)
+        # The library may hold rows the snapshot does not, e.g. while it reloads
+        valid = positions < len(self.rowids)
+        positions, rowids = positions[valid], rowids[valid]
+        return positions[self.rowids[positions] == rowids]
+
+    def trigram_counts(self, words):
+        # Number of tracks containing each trigram of words
+        return {trigram: self.trigrams.get(trigram, 0)
+                for trigram in {word[i:i + TRIGRAM_LENGTH] for word in (word.lower() for word in words)
+                                for i in range(len(word) - TRIGRAM_LENGTH + 1)}}
+
+    def text_mask(self, column, needle):
+        # Rows containing needle in column, or in any searchable column when column is None
+        if not self.indexed:
+            # Without the index, bare words only search the filename
+            return self.scan_mask(column or 'filename', needle)
+        counts = self.trigram_counts([needle])
+        if counts and min(counts.values()) == 0:
+            return np.zeros(len(self), dtype=bool)
+        if not counts or min(counts.values()) > self.common_count():
+            mask = np.zeros(len(self), dtype=bool)
+            for searched in ([column] if column else SCANNED_COLUMNS):
+                mask |= self.scan_mask(searched, needle)
+            return mask
+        phrase = '"' + needle.replace('"', '""') + '"'
+        return self.rows_mask(self.conn.execute('SELECT rowid FROM playlist_fts WHERE playlist_fts MATCH ?',
+                                                (f'{column}: {phrase}' if column else phrase,)))
+
+    def fuzzy_mask(self, words):
+        # The FUZZY_LIMIT rows sharing the most trigrams with words, best ranked by the index.
+        # Trigrams most tracks contain say nothing about which is closest, so they are left out, and so
+        # are those every track contains in a library small enough for them to pass the count.
+        if not self.indexed:
+            return np.zeros(len(self), dtype=bool)
+        trigrams = sorted(trigram for trigram, count in self.trigram_counts(words).items()
+                          if 0 < count <= self.common_count() and count < len(self))
+        if not trigrams:
+            return np.zeros(len(self), dtype=bool)
+        match = ' OR '.join('"' + trigram.replace('"', '""') + '"' for trigram in trigrams)
+        return self.rows_mask(self.conn.execute('''SELECT rowid FROM playlist_fts WHERE playlist_fts MATCH ?
+                                                   ORDER BY rank LIMIT ?''', (match, FUZZY_LIMIT)))
+
+    def scan_mask(self, column, needle):
+        # Vectorized substring search: positions matching the first bytes, compared over the whole array,
+        # then narrowed one byte at a time, so the cost hardly depends on how many rows match
+        haystack, starts = self.haystack(column)
+        needle = np.frombuffer(needle.lower().encode(), np.uint8)
+        length = max(0, len(haystack) - len(needle) + 1)
+        matches = haystack[:length] == needle[0]
+        for offset in range(1, min(TRIGRAM_LENGTH, len(needle))):
+            matches &= haystack[offset:offset + length] == needle[offset]
+        candidates = np.flatnonzero(matches)
+        for offset in range(TRIGRAM_LENGTH, len(needle)):
+            candidates = candidates[haystack[candidates + offset] == needle[offset]]
+        mask = np.zeros(len(self), dtype=bool)
+        mask[np.searchsorted(starts, candidates, side='right') - 1] = True
+        return mask
+
+    def order(self, sort_column_id, descending):
+        # Row positions sorted by a PLAYLIST_COLUMNS column, computed once per column and direction
+        key = (sort_column_id, descending)
+        if key not in self.orders:
+            column = PLAYLIST_COLUMNS[sort_column_id]
+            if column in self.numeric:
+                # Missing values sort first, as SQLite sorts NULLs
+                order = np.argsort(np.nan_to_num(self.numeric[column], nan=-np.inf), kind='stable')
+            elif column in self.text:
+                order = np.argsort(np.array(self.text[column]), kind='stable')
+            else:
+                order = self.rows_order(self.conn.execute(f'SELECT rowid FROM playlist ORDER BY {column}, rowid'))
+            self.orders[key] = order[::-1] if descending else order
+        return self.orders[key]
+
+    def query(self, text, sort_column_id=None, descending=False):
+        # (rowids of the tracks matching text in view order, whether they come from a fuzzy search)
+        rowids = self.select(compile_query(text), sort_column_id, descending)
+        if rowids or not self.indexed or not any(not negate and not field for negate, field, _ in parse_terms(text)):
+            return rowids, False
+        fuzzy_rowids = self.select(compile_query(text, fuzzy=True), sort_column_id, descending)
+        return (fuzzy_rowids, True) if fuzzy_rowids else (rowids, False)
+
+    def select(self, terms, sort_column_id, descending):
+        if terms:
+            mask = np.ones(len(self), dtype=bool)
+            for term in terms:
+                mask &= term(self)
+        if sort_column_id is None:
+            positions = np.flatnonzero(mask) if terms else slice(None)
+        else:
+            positions = self.order(sort_column_id, descending)
+            if terms:
+                positions = positions[mask[positions]]
+        return self.rowids[positions].tolist()
+
+def parse_number(text, field):
+    # (value, unit of its last written digit); durations may also be written as minutes:seconds
+    if field == 'duration' and ':' in text:
+        minutes, _, seconds = text.partition(':')
+        return int(minutes) * 60 + float(seconds), 1.0
+    value = float(text)
+    decimals = len(text.partition('.')[2]) if 'e' not in text.lower() else 0
+    return value, 10.0 ** -decimals
+
+def numeric_term(column, field, value):
+    try:
+        if '..' in value:
+            low, _, high = value.partition('..')
+            if not low and not high:
+                raise ValueError
+            low = parse_number(low, field)[0] if low else -np.inf
+            high = parse_number(high, field)[0] if high else np.inf
+            return lambda table: (table.numeric[column] >= low) & (table.numeric[column] <= high)
+        operator, number = COMPARISON_RE.fullmatch(value).groups()
+        number, unit = parse_number(number, field)
+    except ValueError:
+        raise ValueError(f'{field}: expected a number, a range like 120..128 or a comparison like >0.3, '
+                         f'not "{value}"') from None
+    if operator == '<':
+        return lambda table: table.numeric[column] < number
+    if operator == '<=':
+        return lambda table: table.numeric[column] <= number
+    if operator == '>':
+        return lambda table: table.numeric[column] > number
+    if operator == '>=':
+        return lambda table: table.numeric[column] >= number
+    low, high = number - unit / 2, number + unit / 2
+    return lambda table: (table.numeric[column] >= low) & (table.numeric[column] < high)
+
+def negated(term):
+    return lambda table: ~term(table)
+
+def parse_terms(text):
+    # (negate, field, value) per term, with quotes removed and empty terms skipped
+    for negate, field, value in TERM_RE.findall(text):
+        value = value.strip('"') if value.startswith('"') else value
+        if value:
+            yield bool(negate), field.lower(), value
+
+def compile_query(text, fuzzy=False):
+    # One mask function per term, all of which must match; raises ValueError with a message for the user.
+    # fuzzy=True turns the bare words into a single fuzzy search term.
+    terms = []
+    fuzzy_words = []
+    for negate, field, value in parse_terms(text):
+        if field in NUMERIC_FIELDS:
+            term = numeric_term(NUMERIC_FIELDS[field], field, value)
+        elif fuzzy and not field and not negate:
+            fuzzy_words.append(value)
+            continue
+        elif field in TEXT_FIELDS or not field:
+            term = lambda table, column=TEXT_FIELDS.get(field), value=value: table.text_mask(column, value)
+        else:
+            raise ValueError(f'Unknown field "{field}"; use one of {", ".join(sorted({**NUMERIC_FIELDS, **TEXT_FIELDS}))}')
+        terms.append(negated(term) if negate else term)
+    if fuzzy_words:
+        terms.append(lambda table: table.fuzzy_mask(fuzzy_words))
+    return terms
+
+class QueryRunner:
+    # Runs search queries on a background thread, so typing never waits on loading or sorting.
+    # The thread opens its own library connection and loads the LibraryTable on the first query after
+    # startup or a reload, so a player that is never searched never holds the snapshot. Only the
+    # latest request is run; results go to deliver(generation, rowids, message), where rowids is None
+    # and message the error for a query that does not parse or a library that could not be read, or
+    # message notes a fuzzy result. The caller drops any whose generation is no longer the latest.
+
+    def __init__(self, open_connection, deliver):
+        self.open_connection = open_connection
+        self.deliver = deliver
+        self.condition = threading.Condition()
+        self.request = None
+        self.generation = 0
+        self.stale = True
+        self.table = None
+        self.conn = None
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, text, sort_column_id=None, descending=False, reload=False):
+        # reload=True drops the snapshot, for after the library itself has changed
+        with self.condition:
+            self.generation += 1
+            self.request = (self.generation, text, sort_column_id, descending)
+            self.stale = self.stale or reload
+            self.condition.notify()
+        return self.generation
+
+    def cancel(self, reload=False):
+        # For a view that needs no query: results still on their way are dropped
+        with self.condition:
+            self.generation += 1
+            self.request = None
+            self.stale = self.stale or reload
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.request is None:
+                    self.condition.wait()
+                generation, text, sort_column_id, descending = self.request
+                self.request = None
+                reload, self.stale = self.stale, False
+            try:
+                if reload:
+                    self.table = None
+                    if self.conn is not None:
+                        self.conn.close()
+                        self.conn = None
+                    self.conn = self.open_connection()
+                    self.table = LibraryTable.from_library(self.conn)
+                rowids, fuzzy = self.table.query(text, sort_column_id, descending)
+                message = 'No exact matches; showing the closest' if fuzzy else None
+            except ValueError as e:
+                rowids, message = None, str(e)
+            except Exception as e:
+                # Report the failure and keep serving requests, or the views would stop updating
+                print(f"Search failed: {e!r}")
+                rowids, message = None, f'Search failed: {e}'
+            if self.table is None:
+                # The library did not load, so the next request tries again
+                with self.condition:
+                    self.stale = True
+            self.deliver(generation, rowids, message)
@@ -0,0 +1,113 @@
+import os
+import threading
+import gi
+
+gi.require_version('Gst', '1.0')
+import gi.repository.Gst as Gst
+
+class PlaybackQueue:
+    # Gapless playback over a list of tracks with a single long-lived playbin.
+    # The next track's URI is worked out on the main thread as soon as a track starts, and handed to
+    # playbin from its about-to-finish signal, so playbin pre-rolls it while the current one drains.
+    # Manual switches go through READY instead of NULL, which keeps the audio sink open.
+
+    def __init__(self, on_track_changed=None):
+        Gst.init(None)
+        self.player = Gst.ElementFactory.make("playbin", "player")
+        self.player.connect("about-to-finish", self.on_about_to_finish)
+        bus = self.player.get_bus()
+        bus.add_signal_watch()
+        bus.connect("message::stream-start", self.on_stream_start)
+        bus.connect("message::eos", self.on_eos)
+        bus.connect("message::error", self.on_error)
+        self.on_track_changed = on_track_changed
+        self.tracks = []
+        self.index = None
+        # Written on the main thread, read from the streaming thread in on_about_to_finish
+        self.lock = threading.Lock()
+        self.next_uri = None
+        self.next_queued = False
+
+    def play(self, tracks, index):
+        # tracks is any sequence of file paths: a list, or a view onto the library model
+        self.tracks = tracks
+        self.index = index
+        self.player.set_state(Gst.State.READY)
+        self.player.set_property("uri", Gst.filename_to_uri(tracks[index]))
+        self.player.set_state(Gst.State.PLAYING)
+        self.prepare_next()
+        if self.on_track_changed:
+            self.on_track_changed(self.tracks, self.index)
+
+    def next(self):
+        if self.index is not None and self.index + 1 < len(self.tracks):
+            self.play(self.tracks, self.index + 1)
+
+    def position(self):
+        # Playback position in seconds, or None before the pipeline knows it
+        ok, position = self.player.query_position(Gst.Format.TIME)
+        return position / Gst.SECOND if ok else None
+
+    def seek(self, seconds):
+        self.player.seek_simple(Gst.Format.TIME, Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT,
+                                int(seconds * Gst.SECOND))
+
+    def stop(self):
+        self.player.set_state(Gst.State.NULL)
+        self.index = None
+        with self.lock:
+            self.next_uri = None
+            self.next_queued = False
+
+    def prepare_next(self):
+        next_uri = None
+        if self.index is not None and self.index + 1 < len(self.tracks):
+            next_file = self.tracks[self.index + 1]
+            next_uri = Gst.filename_to_uri(next_file)
+            warm_page_cache(next_file)
+        with self.lock:
+            self.next_uri = next_uri
+            self.next_queued = False
+
+    def on_about_to_finish(self, playbin):
+        # Runs on a streaming thread; only hands over the URI prepared on the main thread
+        with self.lock:
+            if self.next_uri is not None:
+                playbin.set_property("uri", self.next_uri)
+                self.next_queued = True
+
+    def on_stream_start(self, bus, message):
+        # A queued track has started playing; plain play() calls are already accounted for
+        with self.lock:
+            advanced = self.next_queued
+        if advanced:
+            self.index += 1
+            self.prepare_next()
+            if self.on_track_changed:
+                self.on_track_changed(self.tracks, self.index)
+
+    def on_eos(self, bus, message):
+        # End of the queue
+        self.stop()
+
+    def on_error(self, bus, message):
+        error, debug = message.parse_error()
+        print(f"Playback error: {error.message}")
+        # Skip a broken track instead of stopping the whole queue
+        if self.index is not None and self.index + 1 < len(self.tracks):
+            self.next()
+        else:
+            self.stop()
+
+def warm_page_cache(path):
+    # Ask the kernel to start reading the next file now so its first buffers come from memory
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
@@ -0,0 +1,201 @@
+import os
+import sqlite3
+import numpy as np
+from legacy_db import load_legacy_db, resolve_paths
+from feature_store import is_feature_store, open_store, iter_tracks, CONTRAST_COLUMNS, TAG_COLUMNS
+
+# Persistent library database shared by PlAI.py and select_PlAI.py.
+# It is rebuilt only when the selected analysis database changes; otherwise startup just opens it.
+LIBRARY_SCHEMA_VERSION = 3
+PLAYLIST_COLUMNS = ['file', 'filename', 'tempo', 'duration', 'energy',
+                    'zero_crossing_rate', 'danceability', 'spectral_contrast']
+INDEXED_COLUMNS = ['filename', 'tempo', 'duration', 'energy', 'danceability']
+LOAD_BATCH_SIZE = 2000
+# Numeric copies of the spectral contrast bands, used by the similarity index, then the tags
+LIBRARY_COLUMNS = PLAYLIST_COLUMNS + CONTRAST_COLUMNS + TAG_COLUMNS
+# Columns in the playlist_fts full-text index, an FTS5 trigram index over the playlist table
+SEARCH_COLUMNS = ['filename', 'file'] + TAG_COLUMNS
+
+def default_library_file():
+    data_home = os.environ.get('XDG_DATA_HOME') or os.path.join(os.path.expanduser('~'), '.local', 'share')
+    return os.path.join(data_home, 'PlAI', 'library.sqlite')
+
+def create_playlist_table(conn, name='playlist'):
+    contrast = ', '.join(f'{column} REAL' for column in CONTRAST_COLUMNS)
+    tags = ', '.join(f'{column} TEXT' for column in TAG_COLUMNS)
+    conn.execute(f'''CREATE TABLE {name}
+                    (file TEXT, filename TEXT, tempo REAL, duration REAL, energy REAL,
+                    zero_crossing_rate REAL, danceability REAL, spectral_contrast TEXT, {contrast}, {tags})''')
+
+def create_playlist_indexes(conn):
+    for column in INDEXED_COLUMNS:
+        conn.execute(f'CREATE INDEX idx_playlist_{column} ON playlist ({column})')
+    conn.execute('CREATE INDEX idx_playlist_file ON playlist (file)')
+
+def open_library(path=None):
+    path = path or default_library_file()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    row = None
+    if conn.execute("SELECT name FROM sqlite_master WHERE name = 'library_meta'").fetchone():
+        row = conn.execute("SELECT value FROM library_meta WHERE key = 'schema_version'").fetchone()
+    if row is None or int(row[0]) != LIBRARY_SCHEMA_VERSION:
+        # The library is only a cache of the analysis database, so an old layout is simply recreated
+        with conn:
+            conn.execute('DROP TABLE IF EXISTS playlist_fts_vocab')
+            conn.execute('DROP TABLE IF EXISTS playlist_fts')
+            conn.execute('DROP TABLE IF EXISTS playlist')
+            conn.execute('DROP TABLE IF EXISTS playlist_staging')
+            conn.execute('DROP TABLE IF EXISTS library_meta')
+            create_playlist_table(conn)
+            try:
+                # Trigram tokens match any substring of three or more characters, case-insensitively
+                conn.execute(f'''CREATE VIRTUAL TABLE playlist_fts USING fts5({', '.join(SEARCH_COLUMNS)},
+                                content='playlist', content_rowid='rowid', tokenize='trigram')''')
+                # Per-trigram row counts, so a search can tell a selective term from one matching everything
+                conn.execute("CREATE VIRTUAL TABLE playlist_fts_vocab USING fts5vocab(playlist_fts, 'row')")
+            except sqlite3.OperationalError:
+                # SQLite before 3.34 has no trigram tokenizer; search then scans filenames in memory
+                pass
+            create_playlist_indexes(conn)
+            conn.execute('CREATE TABLE library_meta (key TEXT PRIMARY KEY, value TEXT)')
+            conn.execute("INSERT INTO library_meta VALUES ('schema_version', ?)", (str(LIBRARY_SCHEMA_VERSION),))
+    return conn
+
+def get_meta(conn, key, default=None):
+    row = conn.execute('SELECT value FROM library_meta WHERE key = ?', (key,)).fetchone()
+    return row[0] if row else default
+
+def has_search_index(conn):
+    # The full-text index is only rebuilt once a library load completes, so it is usable only then
+    return (get_meta(conn, 'source') is not None
+            and conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'playlist_fts'").fetchone() is not None)
+
+def source_signature(database_file, audio_directory):
+    return f'{os.path.abspath(database_file)}|{os.path.getmtime(database_file)}|{audio_directory or ""}'
+
+def library_is_current(conn, database_file, audio_directory):
+    if not os.path.exists(database_file):
+        return False
+    return get_meta(conn, 'source') == source_signature(database_file, audio_directory)
+
+def read_feature_store(database_file):
+    # Features a profile did not extract are NULL in the store; they read as 0 and contrast as [],
+    # the same as missing values in a scanned_db.txt
+    store = open_store(database_file)
+    for track in iter_tracks(store):
+        spectral_contrast = [track[column] for column in CONTRAST_COLUMNS if track[column] is not None]
+        yield (track['path'], track['filename'],
+               *(track[column] or 0.0 for column in ('tempo_librosa', 'duration_librosa', 'energy',
+                                                     'zero_crossings_librosa', 'danceability')),
+               str(spectral_contrast), *(track[column] for column in CONTRAST_COLUMNS),
+               *(track[column] for column in TAG_COLUMNS))
+    store.close()
+
+def read_scanned_db(database_file, audio_directory):
+    # Librosa values, like read_feature_store; missing values read as 0 as they always have
+    records = load_legacy_db(database_file)
+    numbers = np.nan_to_num(np.column_stack([records[column] for column in
+                                             ('tempo_librosa', 'duration_librosa', 'energy',
+                                              'zero_crossings_librosa', 'danceability')]))
+    paths = resolve_paths(records['filename'].tolist(), audio_directory)
+    for record, full_path, values in zip(records, paths, numbers.tolist()):
+        contrast = record['spectral_contrast']
+        spectral_contrast = contrast[~np.isnan(contrast)].tolist()
+        yield (full_path, os.path.basename(full_path), *values, str(spectral_contrast),
+               *(spectral_contrast + [None] * len(CONTRAST_COLUMNS))[:len(CONTRAST_COLUMNS)],
+               *[None] * len(TAG_COLUMNS))
+
+def read_source(database_file, audio_directory):
+    if is_feature_store(database_file):
+        return read_feature_store(database_file)
+    return read_scanned_db(database_file, audio_directory)
+
+def count_source_rows(database_file):
+    if is_feature_store(database_file):
+        store = open_store(database_file)
+        count = store.execute('SELECT COUNT(*) FROM tracks').fetchone()[0]
+        store.close()
+        return count
+    count = 0
+    with open(database_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            count += chunk.count(b'File:')
+    return count
+
+def rebuild_library(conn, database_file, audio_directory, progress=None, cancel_event=None,
+                    batch_size=LOAD_BATCH_SIZE):
+    # Rows are committed in batches to a staging table, which replaces the playlist in one transaction
+    # once everything is in: views keep showing the previous library until then, and a cancelled or
+    # failed load leaves it untouched. Indexing the finished table is also faster than row by row.
+    total = count_source_rows(database_file) if progress else 0
+    insert = f"INSERT INTO playlist_staging VALUES ({', '.join('?' * len(LIBRARY_COLUMNS))})"
+    conn.execute('DROP TABLE IF EXISTS playlist_staging')
+    create_playlist_table(conn, 'playlist_staging')
+    try:
+        loaded = load_staging(conn, insert, read_source(database_file, audio_directory), batch_size, total,
+                              progress, cancel_event)
+    except BaseException:
+        conn.rollback()
+        conn.execute('DROP TABLE IF EXISTS playlist_staging')
+        raise
+    if loaded is None:
+        conn.execute('DROP TABLE playlist_staging')
+        return False
+    with conn:
+        # An explicit BEGIN, as the table swap is DDL that would otherwise commit on its own
+        conn.execute('BEGIN')
+        conn.execute('DROP TABLE playlist')
+        conn.execute('ALTER TABLE playlist_staging RENAME TO playlist')
+        create_playlist_indexes(conn)
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'playlist_fts'").fetchone():
+            # One bulk pass over the finished table is much faster than indexing row by row
+            conn.execute("INSERT INTO playlist_fts (playlist_fts) VALUES ('rebuild')")
+        conn.executemany('INSERT OR REPLACE INTO library_meta VALUES (?, ?)', [
+            ('source', source_signature(database_file, audio_directory)),
+            ('database_file', database_file),
+            ('audio_directory', audio_directory or ''),
+        ])
+    if progress:
+        progress(loaded, total)
+    conn.execute('ANALYZE')
+    return True
+
+def load_staging(conn, insert, rows, batch_size, total, progress=None, cancel_event=None):
+    # Number of rows inserted, or None when cancel_event was set
+    loaded = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            with conn:
+                conn.executemany(insert, batch)
+            loaded += len(batch)
+            batch = []
+            if progress:
+                progress(loaded, total)
+            if cancel_event is not None and cancel_event.is_set():
+                return None
+    with conn:
+        conn.executemany(insert, batch)
+    return loaded + len(batch)
+
+def sort_clause(sort_column_id, descending):
+    # Sort by column name rather than position so SQLite can walk the matching index
+    if sort_column_id is None:
+        return ''
+    return f"ORDER BY {PLAYLIST_COLUMNS[sort_column_id]} {'DESC' if descending else 'ASC'}"
+
+def fetch_rows(conn, rowids, placeholder=None):
+    # Playlist rows for the given rowids, in the same order; rows that no longer exist are
+    # skipped, or replaced by placeholder when one is given
+    if not rowids:
+        return []
+    placeholders = ', '.join('?' * len(rowids))
+    rows = conn.execute(f"SELECT rowid, {', '.join(PLAYLIST_COLUMNS)} FROM playlist WHERE rowid IN ({placeholders})",
+                        list(rowids)).fetchall()
+    by_rowid = {row[0]: row[1:] for row in rows}
+    if placeholder is not None:
+        return [by_rowid.get(rowid, placeholder) for rowid in rowids]
+    return [by_rowid[rowid] for rowid in rowids if rowid in by_rowid]
@@ -0,0 +1,111 @@
+import os
+import numpy as np
+from feature_store import is_feature_store, open_store, CONTRAST_BANDS, CONTRAST_COLUMNS
+from legacy_db import load_legacy_db
+
+# Batch filter engine shared by the M3U generator window and the command line.
+# Tracks are loaded once into a feature matrix; filters are compiled once into bound arrays.
+FILTER_FEATURES = ['tempo', 'duration', 'energy', 'danceability', 'zero_crossing_rate']
+
+class FeatureTable:
+
+    def __init__(self, files, features, contrast):
+        self.files = files
+        # Column-major so each predicate scans one contiguous column
+        self.features = np.asfortranarray(features)    # (tracks, len(FILTER_FEATURES))
+        self.contrast = np.asfortranarray(contrast)    # (tracks, CONTRAST_BANDS), NaN where a track has no values
+
+    def __len__(self):
+        return len(self.files)
+
+    def column(self, name):
+        return self.features[:, FILTER_FEATURES.index(name)]
+
+def derived_features(tempo, duration, energy, danceability, zcr):
+    # Same rounding as the generator always applied; tracks without a value compare as 0
+    features = np.column_stack([np.round(tempo), np.round(duration, 3), np.round(energy, 3),
+                                np.round(danceability, 3), np.round(zcr, 3)])
+    return np.nan_to_num(features, nan=0.0)
+
+def load_feature_table(db_file):
+    if is_feature_store(db_file):
+        store = open_store(db_file)
+        rows = store.execute(f'''SELECT path, tempo_librosa, tempo_essentia, duration_librosa, duration_essentia,
+                                energy, danceability, zero_crossings_librosa, zero_crossing_rate,
+                                {', '.join(CONTRAST_COLUMNS)} FROM tracks ORDER BY filename''').fetchall()
+        store.close()
+        files = [row[0] for row in rows]
+        values = np.array([tuple(row)[1:] for row in rows], dtype=np.float64).reshape(len(rows), 8 + CONTRAST_BANDS)
+        features = derived_features((values[:, 0] + values[:, 1]) / 2, (values[:, 2] + values[:, 3]) / 2,
+                                    values[:, 4], values[:, 5], (values[:, 6] + values[:, 7]) / 2)
+        return FeatureTable(files, features, np.round(values[:, 8:], 3))
+
+    records = load_legacy_db(db_file)
+    features = derived_features((records['tempo_librosa'] + records['tempo_essentia']) / 2,
+                                (records['duration_librosa'] + records['duration_essentia']) / 2,
+                                records['energy'], records['danceability'],
+                                (records['zero_crossings_librosa'] + records['zero_crossing_rate']) / 2)
+    return FeatureTable(records['filename'].tolist(), features, np.round(records['spectral_contrast'], 3))
+
+def parse_bound(text):
+    text = (text or '').strip()
+    return float(text) if text else None
+
+def parse_contrast_bound(text):
+    # One value applies to every band, otherwise one value per band
+    text = (text or '').strip()
+    if not text:
+        return None
+    values = np.array([float(x) for x in text.split(',')])
+    if len(values) not in (1, CONTRAST_BANDS):
+        raise ValueError(f'spectral contrast takes one value or {CONTRAST_BANDS}, got {len(values)}')
+    return values
+
+def compile_filters(ranges, contrast_min=None, contrast_max=None):
+    # ranges maps a FILTER_FEATURES name to (min, max); None means unbounded
+    low = np.full(len(FILTER_FEATURES), -np.inf)
+    high = np.full(len(FILTER_FEATURES), np.inf)
+    for name, (minimum, maximum) in ranges.items():
+        i = FILTER_FEATURES.index(name)
+        if minimum is not None:
+            low[i] = minimum
+        if maximum is not None:
+            high[i] = maximum
+    contrast_low = np.broadcast_to(contrast_min if contrast_min is not None else -np.inf, (CONTRAST_BANDS,))
+    contrast_high = np.broadcast_to(contrast_max if contrast_max is not None else np.inf, (CONTRAST_BANDS,))
+    return low, high, contrast_low, contrast_high
+
+def filter_mask(table, bounds):
+    low, high, contrast_low, contrast_high = bounds
+    mask = np.ones(len(table), dtype=bool)
+    # Only bounded columns are evaluated
+    for i in np.flatnonzero(np.isfinite(low)):
+        mask &= table.features[:, i] >= low[i]
+    for i in np.flatnonzero(np.isfinite(high)):
+        mask &= table.features[:, i] <= high[i]
+    # NaN compares false, so tracks without spectral contrast values are not filtered on contrast
+    for i in np.flatnonzero(np.isfinite(contrast_low)):
+        mask &= ~(table.contrast[:, i] < contrast_low[i])
+    for i in np.flatnonzero(np.isfinite(contrast_high)):
+        mask &= ~(table.contrast[:, i] > contrast_high[i])
+    return mask
+
+def filter_files(table, bounds, sort_key=None):
+    # sort_key is 'filename' or a FILTER_FEATURES name, prefixed with '-' for descending order
+    indices = np.flatnonzero(filter_mask(table, bounds))
+    if sort_key:
+        name = sort_key.lstrip('-')
+        if name == 'filename':
+            keys = np.array([os.path.basename(table.files[i]).lower() for i in indices])
+        else:
+            keys = table.column(name)[indices]
+        order = np.argsort(keys, kind='stable')
+        indices = indices[order[::-1] if sort_key.startswith('-') else order]
+    return [table.files[i] for i in indices]
+
+def write_m3u(playlist_file, files):
+    with open(playlist_file, 'w') as f:
+        f.write("#EXTM3U\n")
+        for file in files:
+            f.write(f"#EXTINF:-1,{os.path.basename(file)}\n")
+            f.write(f"{file}\n")
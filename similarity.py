@@ -0,0 +1,74 @@
+import os
+import threading
+import numpy as np
+from feature_store import CONTRAST_COLUMNS
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+# Feature vector used for "similar tracks": every column is z-score normalized, then scaled by its weight
+SIMILARITY_FEATURES = ['tempo', 'energy', 'danceability', 'zero_crossing_rate'] + CONTRAST_COLUMNS
+DEFAULT_WEIGHTS = {'tempo': 2.0, 'energy': 1.0, 'danceability': 1.5, 'zero_crossing_rate': 1.0}
+DEFAULT_CONTRAST_WEIGHT = 0.5
+DEFAULT_TOP_K = 50
+
+def load_feature_matrix(conn):
+    rows = conn.execute(f"SELECT rowid, file, {', '.join(SIMILARITY_FEATURES)} FROM playlist").fetchall()
+    rowids = np.array([row[0] for row in rows], dtype=np.int64)
+    files = [row[1] for row in rows]
+    matrix = np.array([row[2:] for row in rows], dtype=np.float64).reshape(len(rows), len(SIMILARITY_FEATURES))
+    return rowids, files, matrix
+
+class SimilarityIndex:
+
+    def __init__(self, rowids, files, matrix, weights=None):
+        weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+        self.rowids = rowids
+        self.files = files
+        self.positions = {file: i for i, file in enumerate(files)}
+
+        # Energy spans several orders of magnitude, so compare it on a log scale
+        matrix = np.nan_to_num(matrix.copy())
+        self.tempo = matrix[:, SIMILARITY_FEATURES.index('tempo')].copy()
+        energy = SIMILARITY_FEATURES.index('energy')
+        matrix[:, energy] = np.log1p(np.maximum(matrix[:, energy], 0.0))
+        self.log_energy = matrix[:, energy].copy()
+
+        std = matrix.std(axis=0)
+        std[std == 0] = 1.0
+        scale = np.array([weights.get(name, DEFAULT_CONTRAST_WEIGHT) for name in SIMILARITY_FEATURES])
+        self.vectors = (matrix - matrix.mean(axis=0)) / std * scale
+        self.tree = cKDTree(self.vectors) if cKDTree is not None and len(self.vectors) else None
+
+    @classmethod
+    def from_library(cls, conn, cache_file=None, source=None, weights=None):
+        # The raw matrix is cached next to the library and reused while the library source is unchanged
+        if cache_file and source and os.path.exists(cache_file):
+            cached = np.load(cache_file, allow_pickle=False)
+            if str(cached['source']) == source:
+                return cls(cached['rowids'], list(cached['files']), cached['matrix'], weights)
+        rowids, files, matrix = load_feature_matrix(conn)
+        if cache_file and source:
+            # Per thread, as the player may build for the old and the reloaded library at once
+            tmp_file = f'{cache_file}.{os.getpid()}-{threading.get_ident()}.tmp.npz'
+            np.savez(tmp_file, rowids=rowids, files=np.array(files, dtype=str), matrix=matrix, source=source)
+            os.replace(tmp_file, cache_file)
+        return cls(rowids, files, matrix, weights)
+
+    def neighbours(self, file, k=DEFAULT_TOP_K):
+        # Returns library rowids of the k nearest tracks, closest first, excluding the track itself
+        position = self.positions.get(file)
+        if position is None or len(self.vectors) < 2:
+            return []
+        count = min(k + 1, len(self.vectors))
+        query = self.vectors[position]
+        if self.tree is not None:
+            _, nearest = self.tree.query(query, k=count)
+            nearest = np.atleast_1d(nearest)
+        else:
+            distances = np.einsum('ij,ij->i', self.vectors - query, self.vectors - query)
+            nearest = np.argpartition(distances, count - 1)[:count]
+            nearest = nearest[np.argsort(distances[nearest])]
+        return [int(self.rowids[i]) for i in nearest if i != position][:k]
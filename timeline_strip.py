@@ -0,0 +1,78 @@
+import gi
+
+gi.require_version('Gtk', '3.0')
+from gi.repository import Gtk, Gdk
+
+class TimelineStrip(Gtk.DrawingArea):
+    # Waveform strip for the playing track, drawn from the analyzer's stored timeline:
+    # RMS envelope as bars, per-second energy as a line, beats as ticks, and the playhead.
+    # Clicking seeks to that point of the track.
+
+    def __init__(self, on_seek=None, height=48):
+        Gtk.DrawingArea.__init__(self)
+        self.set_size_request(-1, height)
+        self.add_events(Gdk.EventMask.BUTTON_PRESS_MASK)
+        self.connect("draw", self.on_draw)
+        self.connect("button-press-event", self.on_button_press)
+        self.on_seek = on_seek
+        self.timeline = None
+        self.position = 0.0
+
+    def set_timeline(self, timeline):
+        self.timeline = timeline
+        self.position = 0.0
+        self.queue_draw()
+
+    def set_position(self, position):
+        self.position = position
+        self.queue_draw()
+
+    def on_draw(self, widget, cr):
+        width = self.get_allocated_width()
+        height = self.get_allocated_height()
+        cr.set_source_rgb(0.15, 0.15, 0.15)
+        cr.paint()
+        timeline = self.timeline
+        if timeline is None or not timeline['duration']:
+            return False
+
+        rms = timeline['rms']
+        peak = rms.max() if len(rms) else 0.0
+        if peak > 0:
+            # Bars mirrored around the middle, like a waveform overview
+            bar_width = width / len(rms)
+            cr.set_source_rgb(0.45, 0.7, 0.9)
+            for i, value in enumerate(rms / peak):
+                bar_height = max(1.0, value * (height - 4))
+                cr.rectangle(i * bar_width, (height - bar_height) / 2, max(1.0, bar_width - 0.5), bar_height)
+            cr.fill()
+
+        energy = timeline['energy']
+        energy_peak = energy.max() if len(energy) else 0.0
+        if energy_peak > 0:
+            cr.set_source_rgb(0.95, 0.6, 0.2)
+            cr.set_line_width(1.0)
+            step = width / len(energy)
+            for i, value in enumerate(energy / energy_peak):
+                x, y = (i + 0.5) * step, height - 2 - value * (height - 4)
+                if i:
+                    cr.line_to(x, y)
+                else:
+                    cr.move_to(x, y)
+            cr.stroke()
+
+        scale = width / timeline['duration']
+        cr.set_source_rgba(1.0, 1.0, 1.0, 0.35)
+        for beat in timeline['beats']:
+            cr.rectangle(beat * scale, height - 4, 1.0, 4)
+        cr.fill()
+
+        cr.set_source_rgb(1.0, 0.25, 0.25)
+        cr.rectangle(min(self.position * scale, width - 2), 0, 2, height)
+        cr.fill()
+        return False
+
+    def on_button_press(self, widget, event):
+        if self.timeline is not None and self.on_seek is not None and self.timeline['duration']:
+            self.on_seek(event.x / self.get_allocated_width() * self.timeline['duration'])
+        return True